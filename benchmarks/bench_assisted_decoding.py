@@ -0,0 +1,114 @@
+"""Measure assisted (speculative) decoding with a draft model against greedy decoding, per language and task.
+
+The model transcribes and translates the DOLMA-speech test set of each language, or bot manifests, three ways through
+the `Transcriber` of transcribe.py: greedily in batches, greedily one clip at a time, and one clip at a time with the
+draft model. The script reports the share of drafted tokens the model accepted, the tokens added per forward pass
+of the model, the speed-up over both greedy runs, and whether the assisted predictions equal the greedy ones:
+
+    python benchmarks/bench_assisted_decoding.py --model_name_or_path ./whisper-base-me \\
+        --assistant_model_name_or_path ./whisper-tiny-me --languages hawrami gilaki
+    python benchmarks/bench_assisted_decoding.py --model_name_or_path ./whisper-base-me \\
+        --assistant_model_name_or_path ./whisper-tiny-me --manifests dataset/hawrami/metadata.csv
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+
+import librosa
+import numpy as np
+import torch
+from datasets import Audio, load_dataset
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from transcribe import Transcriber, language_code, window_features  # noqa: E402
+
+SAMPLING_RATE = 16000
+
+
+def load_test_sets(args):
+    """Lists of (language, audio arrays)."""
+    test_sets = []
+    for lang_name in args.languages:
+        dataset = load_dataset("razhan/DOLMA-speech", lang_name, split="test")
+        dataset = dataset.select(range(min(args.max_eval_samples, len(dataset))))
+        dataset = dataset.cast_column("audio", Audio(sampling_rate=SAMPLING_RATE))
+        test_sets.append((lang_name, [sample["array"] for sample in dataset["audio"]]))
+    for manifest in args.manifests:
+        with open(manifest, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))[: args.max_eval_samples]
+        arrays = [
+            librosa.load(os.path.join(os.path.dirname(manifest), row["file_name"]), sr=SAMPLING_RATE)[0]
+            for row in rows
+        ]
+        test_sets.append((rows[0]["language"], arrays))
+    return test_sets
+
+
+def generate(transcriber, chunks, lang_name, task, batch_size):
+    """Token ids of every window, batched in order of duration, and the seconds it took."""
+    order = np.argsort([chunk["duration"] for chunk in chunks])
+    token_ids = [None] * len(chunks)
+    start = time.perf_counter()
+    for batch_start in range(0, len(order), batch_size):
+        indices = order[batch_start : batch_start + batch_size]
+        input_features = transcriber.stack_features([chunks[i] for i in indices])
+        languages = [language_code(lang_name)] * len(indices)
+        for i, row in zip(indices, transcriber.generate(input_features, languages, task)):
+            token_ids[i] = row
+    return token_ids, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model_name_or_path", required=True)
+    parser.add_argument("--assistant_model_name_or_path", required=True)
+    parser.add_argument("--languages", nargs="*", default=[], help="DOLMA-speech configs to evaluate on.")
+    parser.add_argument("--manifests", nargs="*", default=[], help="Bot manifests to evaluate on.")
+    parser.add_argument("--tasks", nargs="+", default=["transcribe", "translate"])
+    parser.add_argument("--max_eval_samples", type=int, default=100, help="Utterances per language.")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--max_new_tokens", type=int, default=225)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    greedy = Transcriber(args.model_name_or_path, device=args.device, max_new_tokens=args.max_new_tokens)
+    assisted = Transcriber(
+        args.model_name_or_path,
+        device=args.device,
+        max_new_tokens=args.max_new_tokens,
+        assistant_model_name_or_path=args.assistant_model_name_or_path,
+    )
+    feature_extractor = greedy.processor.feature_extractor
+    test_sets = load_test_sets(args)
+    # warm up allocations
+    warm_up = [window_features(array, feature_extractor)[0] for array in test_sets[0][1][:2]]
+    generate(greedy, warm_up, test_sets[0][0], args.tasks[0], 2)
+    generate(assisted, warm_up, test_sets[0][0], args.tasks[0], 1)
+
+    print(f"{args.device}, {torch.get_num_threads()} threads, greedy batch size {args.batch_size}")
+    print(
+        f"{'language':<18} {'task':<10} {'batched s':>9} {'single s':>9} {'assisted s':>10} {'vs batched':>10} "
+        f"{'vs single':>9} {'accepted':>8} {'tok/pass':>8} {'equal':>6}"
+    )
+    for lang_name, arrays in test_sets:
+        chunks = [chunk for array in arrays for chunk in window_features(array, feature_extractor)]
+        for task in args.tasks:
+            _, batched_seconds = generate(greedy, chunks, lang_name, task, args.batch_size)
+            single_ids, single_seconds = generate(greedy, chunks, lang_name, task, 1)
+            assisted.assisted_stats.reset()
+            assisted_ids, assisted_seconds = generate(assisted, chunks, lang_name, task, 1)
+            stats = assisted.assisted_stats.metrics()
+            # batched greedy decoding can differ from single clips in the last bits of the padded batch, so the
+            # assisted predictions are compared with the single clip ones
+            equal = np.mean([a == b for a, b in zip(assisted_ids, single_ids)])
+            print(
+                f"{lang_name:<18} {task:<10} {batched_seconds:>9.2f} {single_seconds:>9.2f} {assisted_seconds:>10.2f} "
+                f"{batched_seconds / assisted_seconds:>9.2f}x {single_seconds / assisted_seconds:>8.2f}x "
+                f"{stats['draft_acceptance_rate']:>8.1%} {stats['tokens_per_model_pass']:>8.2f} {equal:>6.1%}"
+            )
+
+
+if __name__ == "__main__":
+    main()
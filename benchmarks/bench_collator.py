@@ -0,0 +1,100 @@
+"""Time the data collators of finetune_whisper.py on CPU.
+
+Batches of cached log-mel features are read from a memory-mapped Arrow cache and collated once through Python lists
+and `feature_extractor.pad` (`DataCollatorSpeechSeq2SeqWithPadding`) and once from NumPy views stacked with a single
+copy (`DataCollatorSpeechSeq2SeqWithStacking`). Both the time to fetch the examples and the time to collate them are
+reported per batch:
+
+    python benchmarks/bench_collator.py --model_name_or_path openai/whisper-base --batch_sizes 32 64 128
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import datasets
+import numpy as np
+from transformers import AutoProcessor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from finetune_whisper import (  # noqa: E402
+    DataCollatorSpeechSeq2SeqWithPadding,
+    DataCollatorSpeechSeq2SeqWithStacking,
+    MultiTaskSpeechDataset,
+    compress_input_features,
+)
+
+
+def build_cache(processor, args, cache_dir):
+    rng = np.random.default_rng(0)
+    feature_extractor = processor.feature_extractor
+    num_utterances = max(args.batch_sizes)
+
+    def generate():
+        for _ in range(num_utterances):
+            input_features = rng.standard_normal(
+                (1, feature_extractor.feature_size, feature_extractor.nb_max_frames), dtype=np.float32
+            )
+            stored, scales = compress_input_features(input_features, args.feature_storage_dtype)
+            row = {"input_features": stored[0], "attention_mask": np.ones(feature_extractor.nb_max_frames, np.int32)}
+            if scales is not None:
+                row["input_features_scale"] = scales[0]
+            yield row
+
+    features = datasets.Dataset.from_generator(generate, cache_dir=cache_dir)
+    features.save_to_disk(os.path.join(cache_dir, "features"))
+    features = datasets.load_from_disk(os.path.join(cache_dir, "features"))
+    labels = [rng.integers(0, len(processor.tokenizer), rng.integers(10, 60)).tolist() for _ in range(num_utterances)]
+    index = datasets.Dataset.from_dict(
+        {"utterance_idx": list(range(num_utterances)), "labels": labels, "input_length": [16000] * num_utterances}
+    )
+    return features, index
+
+
+def time_batches(dataset, collator, batch_size, num_batches):
+    fetch, collate = [], []
+    for _ in range(num_batches):
+        start = time.perf_counter()
+        examples = [dataset[i] for i in range(batch_size)]
+        fetched = time.perf_counter()
+        collator(examples)
+        fetch.append(fetched - start)
+        collate.append(time.perf_counter() - fetched)
+    return np.median(fetch) * 1000, np.median(collate) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model_name_or_path", default="openai/whisper-base")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[32, 64, 128])
+    parser.add_argument("--num_batches", type=int, default=3)
+    parser.add_argument("--feature_storage_dtype", default="float32", choices=["float32", "float16", "int8"])
+    args = parser.parse_args()
+
+    processor = AutoProcessor.from_pretrained(args.model_name_or_path)
+    features, index = build_cache(processor, args, tempfile.mkdtemp(prefix="bench_collator_"))
+    collator_kwargs = {"processor": processor, "decoder_start_token_id": 0, "forward_attention_mask": True}
+    pipelines = [
+        (
+            "lists + pad",
+            MultiTaskSpeechDataset(features, index),
+            DataCollatorSpeechSeq2SeqWithPadding(**collator_kwargs),
+        ),
+        (
+            "numpy stack",
+            MultiTaskSpeechDataset(features, index, numpy_views=True),
+            DataCollatorSpeechSeq2SeqWithStacking(**collator_kwargs),
+        ),
+    ]
+
+    print(f"storage dtype: {args.feature_storage_dtype}, median of {args.num_batches} batches")
+    print(f"{'collator':<12} {'batch':>6} {'fetch ms':>10} {'collate ms':>11} {'total ms':>10}")
+    for batch_size in args.batch_sizes:
+        for name, dataset, collator in pipelines:
+            fetch, collate = time_batches(dataset, collator, batch_size, args.num_batches)
+            print(f"{name:<12} {batch_size:>6} {fetch:>10.1f} {collate:>11.1f} {fetch + collate:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Compare a distilled student (finetune_whisper.py --teacher_model_name_or_path) with its teacher, per language.
+
+Both models transcribe and translate the DOLMA-speech test set of each language through the `Transcriber` of
+transcribe.py. The script reports their decoding time, the speed-up of the student and its WER/CER and BLEU/chrF
+next to the teacher's:
+
+    python benchmarks/bench_distillation.py --teacher ./whisper-base-me --student ./whisper-tiny-distilled \\
+        --languages hawrami gilaki zazaki --num_threads 4
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from datasets import Audio, load_dataset
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from finetune_whisper import preprocess_batch, text_metric_counts, text_metric_scores  # noqa: E402
+from transcribe import Transcriber, language_code, stitch_chunks, window_features  # noqa: E402
+
+SAMPLING_RATE = 16000
+
+
+def transcribe(transcriber, arrays, lang_name, task, batch_size):
+    """Predictions for `arrays`, batched in order of duration, and the seconds it took."""
+    feature_extractor = transcriber.processor.feature_extractor
+    order = np.argsort([len(array) for array in arrays])
+    predictions = [None] * len(arrays)
+    start = time.perf_counter()
+    for batch_start in range(0, len(order), batch_size):
+        indices = order[batch_start : batch_start + batch_size]
+        clip_chunks = [window_features(arrays[i], feature_extractor) for i in indices]
+        chunks = [chunk for chunks in clip_chunks for chunk in chunks]
+        token_ids = transcriber.generate(
+            transcriber.stack_features(chunks), [language_code(lang_name)] * len(chunks), task
+        )
+        offset = 0
+        for i, chunks in zip(indices, clip_chunks):
+            predictions[i] = transcriber.decode(stitch_chunks(token_ids[offset : offset + len(chunks)]))
+            offset += len(chunks)
+    return predictions, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--teacher", required=True)
+    parser.add_argument("--student", required=True)
+    parser.add_argument("--languages", nargs="+", required=True, help="DOLMA-speech configs to evaluate on.")
+    parser.add_argument("--max_eval_samples", type=int, default=100, help="Utterances per language.")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--max_new_tokens", type=int, default=225)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--num_threads", type=int, default=None)
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    models = {
+        name: Transcriber(path, device=args.device, max_new_tokens=args.max_new_tokens)
+        for name, path in (("teacher", args.teacher), ("student", args.student))
+    }
+    for name, transcriber in models.items():
+        config = transcriber.model.config
+        num_parameters = sum(parameter.numel() for parameter in transcriber.model.parameters())
+        print(
+            f"{name}: {num_parameters / 1e6:.1f}M parameters, {config.encoder_layers} encoder and "
+            f"{config.decoder_layers} decoder layers"
+        )
+    print(f"{args.device}, {torch.get_num_threads()} threads, batch size {args.batch_size}")
+    print(
+        f"{'language':<18} {'task':<10} {'teacher s':>9} {'student s':>9} {'speed-up':>9} "
+        f"{'metric':<9} {'teacher':>8} {'student':>8}"
+    )
+    for lang_name in args.languages:
+        dataset = load_dataset("razhan/DOLMA-speech", lang_name, split="test")
+        dataset = dataset.select(range(min(args.max_eval_samples, len(dataset))))
+        dataset = dataset.cast_column("audio", Audio(sampling_rate=SAMPLING_RATE))
+        arrays = [sample["array"] for sample in dataset["audio"]]
+        references = {
+            "transcribe": preprocess_batch(dataset["sentence"]),
+            "translate": preprocess_batch([text.lower() for text in dataset["english"]]),
+        }
+        for task in ("transcribe", "translate"):
+            seconds, scores = {}, {}
+            for name, transcriber in models.items():
+                # warm up allocations
+                transcribe(transcriber, arrays[: args.batch_size], lang_name, task, args.batch_size)
+                predictions, seconds[name] = transcribe(transcriber, arrays, lang_name, task, args.batch_size)
+                counts = text_metric_counts(preprocess_batch(predictions), references[task], task)
+                scores[name] = text_metric_scores(counts, task)
+            for i, metric in enumerate(scores["teacher"]):
+                timing = (
+                    f"{seconds['teacher']:>9.2f} {seconds['student']:>9.2f} "
+                    f"{seconds['teacher'] / seconds['student']:>8.2f}x"
+                    if i == 0
+                    else " " * 29
+                )
+                print(
+                    f"{lang_name:<18} {task:<10} {timing} {metric:<9} "
+                    f"{scores['teacher'][metric]:>8.4f} {scores['student'][metric]:>8.4f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""Compare full 30 second padding with `--encoder_length_buckets` in finetune_whisper.py.
+
+On CPU the script times a training step (forward and backward) of batches of 2-8 second clips padded to 30 seconds
+and trimmed to the duration buckets. With `--model_name_or_path` pointing to a fine-tuned checkpoint and
+`--languages`, it also transcribes the DOLMA-speech test sets both ways and compares WER/CER:
+
+    python benchmarks/bench_encoder_buckets.py --model_name_or_path openai/whisper-base --buckets 10,20,30
+    python benchmarks/bench_encoder_buckets.py --model_name_or_path ./whisper-base-me --languages hawrami gilaki
+"""
+import argparse
+import os
+import sys
+import time
+
+import evaluate
+import numpy as np
+import torch
+from datasets import Audio, load_dataset
+from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from finetune_whisper import (  # noqa: E402
+    LANGUAGES,
+    DataCollatorSpeechSeq2SeqWithPadding,
+    enable_encoder_length_buckets,
+    preprocess_batch,
+)
+
+
+def parse_buckets(buckets, feature_extractor):
+    frames = {int(float(s) * feature_extractor.sampling_rate / feature_extractor.hop_length) // 2 * 2 for s in buckets}
+    return sorted(frames | {feature_extractor.nb_max_frames})
+
+
+def synthetic_batches(processor, args):
+    rng = np.random.default_rng(0)
+    sampling_rate = processor.feature_extractor.sampling_rate
+    vocab_size = len(processor.tokenizer)
+    batches = []
+    for _ in range(args.num_steps):
+        arrays = [
+            rng.standard_normal(int(rng.uniform(2, 8) * sampling_rate)).astype(np.float32) * 0.1
+            for _ in range(args.batch_size)
+        ]
+        input_features = processor.feature_extractor(arrays, sampling_rate=sampling_rate)["input_features"]
+        labels = rng.integers(0, vocab_size, (args.batch_size, 20)).tolist()
+        batches.append(
+            [
+                {"input_features": features, "input_length": len(array), "labels": labels[i]}
+                for i, (features, array) in enumerate(zip(input_features, arrays))
+            ]
+        )
+    return batches
+
+
+def step_time(model, collator, batches):
+    model.train()
+    times = []
+    for features in batches:
+        batch = collator(features)
+        start = time.perf_counter()
+        model(**batch).loss.backward()
+        times.append(time.perf_counter() - start)
+        model.zero_grad()
+    # the first step includes one-off allocations
+    return np.median(times[1:]) * 1000
+
+
+@torch.no_grad()
+def transcribe(model, collator, dataset, lang_code, batch_size):
+    model.eval()
+    predictions = []
+    # sort by length so that batches fall into the smallest buckets, as in a length-grouped eval
+    order = np.argsort(dataset["input_length"])
+    for start in range(0, len(order), batch_size):
+        features = [dataset[int(i)] for i in order[start : start + batch_size]]
+        batch = collator([{**f, "labels": [0]} for f in features])
+        input_features = batch["input_features"]
+        generated = model.generate(
+            input_features, language=lang_code, task="transcribe", num_segment_frames=input_features.shape[-1]
+        )
+        predictions += collator.processor.batch_decode(generated, skip_special_tokens=True)
+    references = preprocess_batch([dataset[int(i)]["sentence"] for i in order])
+    return preprocess_batch(predictions), references
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model_name_or_path", default="openai/whisper-base")
+    parser.add_argument("--buckets", default="10,20,30", help="Bucket durations in seconds.")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_steps", type=int, default=6)
+    parser.add_argument("--languages", nargs="*", default=[], help="DOLMA-speech configs for the WER comparison.")
+    parser.add_argument("--max_eval_samples", type=int, default=100, help="Utterances per language.")
+    args = parser.parse_args()
+    torch.manual_seed(0)
+
+    processor = AutoProcessor.from_pretrained(args.model_name_or_path)
+    model = AutoModelForSpeechSeq2Seq.from_pretrained(args.model_name_or_path)
+    frame_buckets = parse_buckets(args.buckets.split(","), processor.feature_extractor)
+    collator_kwargs = {
+        "processor": processor,
+        "decoder_start_token_id": model.config.decoder_start_token_id,
+        "forward_attention_mask": False,
+    }
+    full_collator = DataCollatorSpeechSeq2SeqWithPadding(**collator_kwargs)
+    bucket_collator = DataCollatorSpeechSeq2SeqWithPadding(**collator_kwargs, frame_buckets=frame_buckets)
+
+    batches = synthetic_batches(processor, args)
+    full_ms = step_time(model, full_collator, batches)
+    enable_encoder_length_buckets(model)
+    bucket_ms = step_time(model, bucket_collator, batches)
+    print(f"training step, batch size {args.batch_size}, 2-8 s clips, {torch.get_num_threads()} threads")
+    print(f"{'padding':<10} {'ms/step':>10} {'speed-up':>9}")
+    print(f"{'30 s':<10} {full_ms:>10.1f} {1.0:>8.2f}x")
+    print(f"{'buckets':<10} {bucket_ms:>10.1f} {full_ms / bucket_ms:>8.2f}x")
+
+    if not args.languages:
+        return
+    wer_metric = evaluate.load("wer")
+    cer_metric = evaluate.load("cer")
+    sampling_rate = processor.feature_extractor.sampling_rate
+    print(f"\n{'language':<18} {'padding':<8} {'WER':>7} {'CER':>7} {'seconds':>8}")
+    for lang_name in args.languages:
+        dataset = load_dataset("razhan/DOLMA-speech", lang_name, split="test")
+        dataset = dataset.select(range(min(args.max_eval_samples, len(dataset))))
+        dataset = dataset.cast_column("audio", Audio(sampling_rate=sampling_rate))
+        dataset = dataset.map(
+            lambda batch: {
+                "input_features": processor.feature_extractor(
+                    [sample["array"] for sample in batch["audio"]], sampling_rate=sampling_rate
+                )["input_features"],
+                "input_length": [len(sample["array"]) for sample in batch["audio"]],
+            },
+            batched=True,
+            remove_columns=["audio"],
+        )
+        for name, collator in (("30 s", full_collator), ("buckets", bucket_collator)):
+            start = time.perf_counter()
+            predictions, references = transcribe(model, collator, dataset, LANGUAGES[lang_name], args.batch_size)
+            elapsed = time.perf_counter() - start
+            wer = wer_metric.compute(predictions=predictions, references=references)
+            cer = cer_metric.compute(predictions=predictions, references=references)
+            print(f"{lang_name:<18} {name:<8} {wer:>7.4f} {cer:>7.4f} {elapsed:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
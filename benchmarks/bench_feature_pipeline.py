@@ -0,0 +1,167 @@
+"""Compare the cached and the streaming (`--streaming_features`) log-mel pipelines of finetune_whisper.py on CPU.
+
+For both pipelines the script reports the time spent extracting log-mel features, the size of the cached model inputs
+and the number of training samples per second a DataLoader delivers to the model. The cached pipeline extracts the
+features once while preprocessing, the streaming one in the data collator on every epoch; its extraction time is
+measured over the batches of one epoch in the main process:
+
+    python benchmarks/bench_feature_pipeline.py --model_name_or_path openai/whisper-base --dataset_config hawrami \
+        --num_samples 512 --num_workers 4
+"""
+import argparse
+import copy
+import dataclasses
+import os
+import sys
+import tempfile
+import time
+
+import datasets
+import numpy as np
+import torch
+from datasets import Audio, load_dataset
+from transformers import AutoProcessor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from finetune_whisper import (  # noqa: E402
+    DataCollatorSpeechSeq2SeqWithFeatureExtraction,
+    DataCollatorSpeechSeq2SeqWithPadding,
+    MultiTaskSpeechDataset,
+    build_task_index,
+)
+
+
+def load_audio(args, sampling_rate, cache_dir):
+    if args.dataset_config is None:
+        # synthetic 2-8 second clips, encoded to wav so that decoding is part of the measurement
+        rng = np.random.default_rng(0)
+        audio = [
+            {"array": rng.standard_normal(int(rng.uniform(2, 8) * sampling_rate)).astype(np.float32) * 0.1,
+             "sampling_rate": sampling_rate}
+            for _ in range(args.num_samples)
+        ]
+        dataset = datasets.Dataset.from_dict({"audio": audio}).cast_column("audio", Audio())
+    else:
+        dataset = load_dataset("razhan/DOLMA-speech", args.dataset_config, split="train")
+        dataset = dataset.select(range(min(args.num_samples, len(dataset)))).select_columns(["audio"])
+    # keep only the selected clips on disk, still compressed, so that cache sizes are comparable
+    dataset.save_to_disk(os.path.join(cache_dir, "audio"))
+    dataset = datasets.load_from_disk(os.path.join(cache_dir, "audio"))
+    return dataset.cast_column("audio", Audio(sampling_rate=sampling_rate))
+
+
+def add_dummy_labels(dataset, tokenizer):
+    rng = np.random.default_rng(0)
+
+    def labels(length):
+        return [tokenizer.bos_token_id] + rng.integers(0, 50000, length).tolist() + [tokenizer.eos_token_id]
+
+    return datasets.Dataset.from_dict(
+        {
+            "labels_transcribe": [labels(20) for _ in range(len(dataset))],
+            "labels_translate": [labels(30) for _ in range(len(dataset))],
+            "input_length": [16000] * len(dataset),
+        }
+    )
+
+
+def cache_size(dataset):
+    return sum(os.path.getsize(f["filename"]) for f in dataset.cache_files)
+
+
+class TimedFeatureExtractor:
+    """Wraps a feature extractor and sums the time spent in its `__call__`, i.e. in log-mel extraction."""
+
+    def __init__(self, feature_extractor):
+        self.feature_extractor = feature_extractor
+        self.seconds = 0.0
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.feature_extractor(*args, **kwargs)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+    def __getattr__(self, name):
+        return getattr(self.feature_extractor, name)
+
+
+def extraction_time(dataset, collator, args):
+    """Seconds the streaming data collator spends extracting features over one epoch of `dataset`."""
+    timed = TimedFeatureExtractor(collator.processor.feature_extractor)
+    processor = copy.copy(collator.processor)
+    processor.feature_extractor = timed
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=args.batch_size, collate_fn=dataclasses.replace(collator, processor=processor)
+    )
+    for _ in loader:
+        pass
+    return timed.seconds
+
+
+def throughput(dataset, collator, args):
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, collate_fn=collator
+    )
+    start = time.perf_counter()
+    seen = 0
+    for batch in loader:
+        seen += batch["labels"].shape[0]
+    return seen / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model_name_or_path", default="openai/whisper-base")
+    parser.add_argument("--dataset_config", default=None, help="DOLMA-speech config; synthetic audio if unset.")
+    parser.add_argument("--num_samples", type=int, default=512)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--preprocessing_batch_size", type=int, default=64)
+    args = parser.parse_args()
+
+    processor = AutoProcessor.from_pretrained(args.model_name_or_path)
+    feature_extractor = processor.feature_extractor
+    cache_dir = tempfile.mkdtemp(prefix="bench_feature_pipeline_")
+    audio = load_audio(args, feature_extractor.sampling_rate, cache_dir)
+    label_columns = ["labels_transcribe", "labels_translate", "input_length"]
+    index = add_dummy_labels(audio, processor.tokenizer).map(
+        build_task_index, batched=True, with_indices=True, remove_columns=label_columns
+    )
+    collator_kwargs = {
+        "processor": processor,
+        "decoder_start_token_id": processor.tokenizer.bos_token_id,
+        "forward_attention_mask": False,
+    }
+
+    def prepare_features(batch):
+        inputs = feature_extractor([sample["array"] for sample in batch["audio"]], sampling_rate=16000)
+        return {"input_features": inputs["input_features"]}
+
+    start = time.perf_counter()
+    features = audio.map(
+        prepare_features,
+        batched=True,
+        batch_size=args.preprocessing_batch_size,
+        remove_columns=["audio"],
+        cache_file_name=os.path.join(cache_dir, "features.arrow"),
+    )
+    preprocessing_time = time.perf_counter() - start
+    cached = throughput(
+        MultiTaskSpeechDataset(features, index), DataCollatorSpeechSeq2SeqWithPadding(**collator_kwargs), args
+    )
+    streaming_dataset = MultiTaskSpeechDataset(audio, index)
+    streaming_collator = DataCollatorSpeechSeq2SeqWithFeatureExtraction(**collator_kwargs, audio_column_name="audio")
+    streaming_time = extraction_time(streaming_dataset, streaming_collator, args)
+    streaming = throughput(streaming_dataset, streaming_collator, args)
+
+    print(f"utterances: {len(audio)}, training samples: {len(index)}, batch size: {args.batch_size}, "
+          f"workers: {args.num_workers}")
+    print(f"{'pipeline':<10} {'extract s':>13} {'cache MB':>10} {'samples/s':>10}")
+    print(f"{'cached':<10} {preprocessing_time:>13.1f} {cache_size(features) / 2**20:>10.1f} {cached:>10.1f} once")
+    print(f"{'streaming':<10} {streaming_time:>13.1f} {cache_size(audio) / 2**20:>10.1f} {streaming:>10.1f} per epoch")
+
+
+if __name__ == "__main__":
+    main()
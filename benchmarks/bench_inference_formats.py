@@ -0,0 +1,114 @@
+"""Compare the real-time factor and WER/CER of a checkpoint and its exports (export_whisper.py) on CPU.
+
+Every model transcribes the DOLMA-speech test set of each language, or bot manifests with a `sentence` column,
+through the `Transcriber` of transcribe.py, so the timings include the log-mel features as in deployment:
+
+    python export_whisper.py --model_name_or_path ./whisper-base-me --format int8 --output_dir ./whisper-base-me-int8
+    python export_whisper.py --model_name_or_path ./whisper-base-me --format onnx --output_dir ./whisper-base-me-onnx
+    python benchmarks/bench_inference_formats.py --languages hawrami gilaki \\
+        --models fp32=./whisper-base-me int8=./whisper-base-me-int8 onnx=./whisper-base-me-onnx
+    python benchmarks/bench_inference_formats.py --manifests dataset/hawrami/metadata.csv --models ...
+
+The real-time factor is the processing time divided by the duration of the audio; lower is faster.
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+
+import librosa
+import numpy as np
+import torch
+from datasets import Audio, load_dataset
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from finetune_whisper import preprocess_batch, text_metric_counts, text_metric_scores  # noqa: E402
+from transcribe import Transcriber, language_code, stitch_chunks, window_features  # noqa: E402
+
+SAMPLING_RATE = 16000
+
+
+def load_test_sets(args):
+    """Lists of (language, audio arrays, reference sentences)."""
+    test_sets = []
+    for lang_name in args.languages:
+        dataset = load_dataset("razhan/DOLMA-speech", lang_name, split="test")
+        dataset = dataset.select(range(min(args.max_eval_samples, len(dataset))))
+        dataset = dataset.cast_column("audio", Audio(sampling_rate=SAMPLING_RATE))
+        test_sets.append((lang_name, [sample["array"] for sample in dataset["audio"]], dataset["sentence"]))
+    for manifest in args.manifests:
+        with open(manifest, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))[: args.max_eval_samples]
+        arrays = [
+            librosa.load(os.path.join(os.path.dirname(manifest), row["file_name"]), sr=SAMPLING_RATE)[0]
+            for row in rows
+        ]
+        test_sets.append((rows[0]["language"], arrays, [row["sentence"] for row in rows]))
+    return test_sets
+
+
+def transcribe(transcriber, arrays, lang_name, batch_size):
+    """Predictions for `arrays`, batched in order of duration, and the seconds it took."""
+    feature_extractor = transcriber.processor.feature_extractor
+    order = np.argsort([len(array) for array in arrays])
+    predictions = [None] * len(arrays)
+    start = time.perf_counter()
+    for batch_start in range(0, len(order), batch_size):
+        indices = order[batch_start : batch_start + batch_size]
+        clip_chunks = [window_features(arrays[i], feature_extractor) for i in indices]
+        chunks = [chunk for chunks in clip_chunks for chunk in chunks]
+        token_ids = transcriber.generate(
+            transcriber.stack_features(chunks), [language_code(lang_name)] * len(chunks), "transcribe"
+        )
+        offset = 0
+        for i, chunks in zip(indices, clip_chunks):
+            predictions[i] = transcriber.decode(stitch_chunks(token_ids[offset : offset + len(chunks)]))
+            offset += len(chunks)
+    return predictions, time.perf_counter() - start
+
+
+def model_size(path):
+    return sum(
+        os.path.getsize(os.path.join(path, file_name))
+        for file_name in os.listdir(path)
+        if file_name.endswith((".safetensors", ".bin", ".pt", ".onnx", ".onnx_data"))
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", nargs="+", required=True, help="`name=path` of every model to compare.")
+    parser.add_argument("--languages", nargs="*", default=[], help="DOLMA-speech configs to evaluate on.")
+    parser.add_argument("--manifests", nargs="*", default=[], help="Bot manifests with a `sentence` column.")
+    parser.add_argument("--max_eval_samples", type=int, default=100, help="Utterances per language.")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--max_new_tokens", type=int, default=225)
+    parser.add_argument("--num_threads", type=int, default=None)
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    test_sets = load_test_sets(args)
+    print(f"CPU, {torch.get_num_threads()} threads, batch size {args.batch_size}")
+    print(f"{'language':<18} {'model':<10} {'MiB':>7} {'RTF':>7} {'speed-up':>9} {'WER':>7} {'CER':>7}")
+    results = {}
+    for model in args.models:
+        name, path = model.split("=", 1)
+        transcriber = Transcriber(path, device="cpu", max_new_tokens=args.max_new_tokens)
+        # warm up allocations and onnxruntime sessions
+        transcribe(transcriber, test_sets[0][1][: args.batch_size], test_sets[0][0], args.batch_size)
+        for lang_name, arrays, sentences in test_sets:
+            predictions, elapsed = transcribe(transcriber, arrays, lang_name, args.batch_size)
+            rtf = elapsed / (sum(len(array) for array in arrays) / SAMPLING_RATE)
+            counts = text_metric_counts(preprocess_batch(predictions), preprocess_batch(sentences), "transcribe")
+            scores = text_metric_scores(counts, "transcribe")
+            baseline_rtf = results.setdefault(lang_name, rtf)
+            print(
+                f"{lang_name:<18} {name:<10} {model_size(path) / 2**20:>7.1f} {rtf:>7.3f} "
+                f"{baseline_rtf / rtf:>8.2f}x {scores['wer']:>7.4f} {scores['cer']:>7.4f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
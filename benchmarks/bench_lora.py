@@ -0,0 +1,104 @@
+"""Compare full fine-tuning with LoRA adapters (finetune_whisper.py --lora_rank) on memory, step time and size.
+
+Every mode trains a few AdamW steps on synthetic batches of 2-8 second clips, in a fresh process so that the peak
+memory of one mode does not hide another one. The script reports the peak memory (CUDA allocator, or the resident
+set size of the process on CPU), the median step time, the trainable parameters and the size of a saved checkpoint
+(the full model, or the adapter weights only):
+
+    python benchmarks/bench_lora.py --model_name_or_path openai/whisper-base --lora_ranks 8 32
+    python benchmarks/bench_lora.py --model_name_or_path openai/whisper-small --batch_size 16 --device cuda
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+import torch
+from transformers import AutoModelForSpeechSeq2Seq
+
+LORA_TARGET_MODULES = ["q_proj", "k_proj", "v_proj", "out_proj", "fc1", "fc2"]
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def run_mode(args, lora_rank, results):
+    torch.manual_seed(0)
+    model = AutoModelForSpeechSeq2Seq.from_pretrained(args.model_name_or_path)
+    if lora_rank is not None:
+        from peft import LoraConfig, get_peft_model
+
+        config = LoraConfig(r=lora_rank, lora_alpha=2 * lora_rank, target_modules=LORA_TARGET_MODULES)
+        model = get_peft_model(model, config)
+    model.to(args.device).train()
+    parameters = [parameter for parameter in model.parameters() if parameter.requires_grad]
+    optimizer = torch.optim.AdamW(parameters, lr=1e-5)
+
+    rng = np.random.default_rng(0)
+    vocab_size = model.config.vocab_size
+    times = []
+    for _ in range(args.num_steps):
+        input_features = torch.randn(args.batch_size, model.config.num_mel_bins, 3000, device=args.device)
+        labels = torch.from_numpy(rng.integers(0, vocab_size, (args.batch_size, args.label_length))).to(args.device)
+        start = time.perf_counter()
+        model(input_features=input_features, labels=labels).loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        if args.device.startswith("cuda"):
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+
+    if args.device.startswith("cuda"):
+        peak_bytes = torch.cuda.max_memory_allocated()
+    else:
+        # kilobytes on Linux
+        peak_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        model.save_pretrained(checkpoint_dir)
+        checkpoint_bytes = directory_size(checkpoint_dir)
+    results[lora_rank] = {
+        "peak_mib": peak_bytes / 2**20,
+        # the first step includes one-off allocations
+        "step_ms": np.median(times[1:]) * 1000,
+        "trainable": sum(parameter.numel() for parameter in parameters),
+        "checkpoint_mib": checkpoint_bytes / 2**20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model_name_or_path", default="openai/whisper-base")
+    parser.add_argument("--lora_ranks", type=int, nargs="+", default=[8, 32])
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--label_length", type=int, default=64)
+    parser.add_argument("--num_steps", type=int, default=6)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager:
+        results = manager.dict()
+        for lora_rank in [None] + args.lora_ranks:
+            process = context.Process(target=run_mode, args=(args, lora_rank, results))
+            process.start()
+            process.join()
+        results = dict(results)
+
+    full = results[None]
+    print(f"{args.model_name_or_path}, {args.device}, batch size {args.batch_size}, AdamW")
+    print(f"{'mode':<10} {'trainable':>12} {'peak MiB':>9} {'ms/step':>9} {'speed-up':>9} {'checkpoint MiB':>15}")
+    for lora_rank in [None] + args.lora_ranks:
+        result = results[lora_rank]
+        mode = "full" if lora_rank is None else f"LoRA r={lora_rank}"
+        print(
+            f"{mode:<10} {result['trainable']:>12,} {result['peak_mib']:>9.0f} {result['step_ms']:>9.1f} "
+            f"{full['step_ms'] / result['step_ms']:>8.2f}x {result['checkpoint_mib']:>15.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
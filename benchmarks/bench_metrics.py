@@ -0,0 +1,84 @@
+"""Time the evaluation metrics of finetune_whisper.py on a large synthetic multilingual eval set.
+
+The per-group loop that `compute_metrics` used before (a Python mask per language and task, and separate WER, CER,
+BLEU and chrF calls per group) is compared with `compute_grouped_metrics`, which groups the rows in one pass and
+computes the statistics of every group once. Both are checked to give the same per-language scores:
+
+    python benchmarks/bench_metrics.py --num_rows 100000
+"""
+import argparse
+import os
+import sys
+import time
+
+import jiwer
+import numpy as np
+import sacrebleu
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from finetune_whisper import LANGUAGES, compute_grouped_metrics  # noqa: E402
+
+TASKS = ("transcribe", "translate")
+
+
+def per_group_loop(predictions, references, group_keys, group_names):
+    metrics = {}
+    for lang_token_id in set(group_keys[:, 0]):
+        for task_token_id in set(group_keys[:, 1]):
+            if (lang_token_id, task_token_id) not in group_names:
+                continue
+            lang_name, task = group_names[(lang_token_id, task_token_id)]
+            mask = (group_keys[:, 0] == lang_token_id) & (group_keys[:, 1] == task_token_id)
+            preds = [predictions[i] for i, m in enumerate(mask) if m]
+            refs = [references[i] for i, m in enumerate(mask) if m]
+            if task == "transcribe":
+                metrics[f"{lang_name}_wer"] = jiwer.wer(refs, preds)
+                metrics[f"{lang_name}_cer"] = jiwer.cer(refs, preds)
+            else:
+                metrics[f"{lang_name}_bleu"] = sacrebleu.corpus_bleu(preds, [refs]).score
+                metrics[f"{lang_name}_chrf"] = sacrebleu.corpus_chrf(preds, [refs]).score
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num_rows", type=int, default=100_000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    alphabet = list("ابپتجچحخدرزژسشعغفڤقکگلڵمنوۆهەیێ")
+    vocabulary = ["".join(rng.choice(alphabet, rng.integers(2, 8))) for _ in range(5000)]
+    references = [" ".join(rng.choice(vocabulary, rng.integers(3, 20))) for _ in range(args.num_rows)]
+    # predictions with about a fifth of the words replaced
+    predictions = [
+        " ".join(word if rng.random() < 0.8 else rng.choice(vocabulary) for word in text.split())
+        for text in references
+    ]
+    group_keys = np.stack(
+        [rng.integers(0, len(LANGUAGES), args.num_rows), rng.integers(0, len(TASKS), args.num_rows)], axis=1
+    )
+    group_names = {
+        (lang_idx, task_idx): (lang_name, task)
+        for lang_idx, lang_name in enumerate(LANGUAGES)
+        for task_idx, task in enumerate(TASKS)
+    }
+
+    start = time.perf_counter()
+    loop_metrics = per_group_loop(predictions, references, group_keys, group_names)
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    grouped_metrics = compute_grouped_metrics(predictions, references, group_keys, group_names)
+    grouped_time = time.perf_counter() - start
+
+    max_diff = max(abs(loop_metrics[name] - grouped_metrics[name]) for name in loop_metrics)
+    print(f"{args.num_rows} rows, {len(LANGUAGES)} languages x {len(TASKS)} tasks")
+    print(f"{'metrics':<18} {'seconds':>8} {'speed-up':>9}")
+    print(f"{'per-group loop':<18} {loop_time:>8.2f} {1.0:>8.2f}x")
+    print(f"{'grouped':<18} {grouped_time:>8.2f} {loop_time / grouped_time:>8.2f}x")
+    print(f"max difference of the per-language scores: {max_diff:.2e}")
+    for name in sorted(name for name in grouped_metrics if name.startswith("avg_")):
+        print(f"{name:<24} {grouped_metrics[name]:.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Measure the text normalisation throughput of finetune_whisper.py for a large evaluation.
+
+An evaluation normalises every prediction and every reference. The script times that for `--num_sentences`
+predictions and references drawn from the DOLMA-speech sentences (or synthetic ones), once per string without a
+cache and over `--num_evals` evaluations with the memoised `preprocess_batch`:
+
+    python benchmarks/bench_normalizer.py --num_sentences 100000 --languages hawrami gilaki
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from datasets import load_dataset
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from finetune_whisper import preprocess_batch, preprocess_func  # noqa: E402
+
+
+def load_sentences(args):
+    if not args.languages:
+        # synthetic Arabic-script sentences with mixed numerals and punctuation
+        rng = np.random.default_rng(0)
+        alphabet = list("ابپتجچحخدرزژسشعغفڤقکگلڵمنوۆهەیێ١٢٣۴۵۶،.؟!") + [" "] * 6
+        return ["".join(rng.choice(alphabet, rng.integers(20, 120))) for _ in range(args.pool_size)]
+    sentences = []
+    for lang_name in args.languages:
+        for split in ("train", "test"):
+            dataset = load_dataset("razhan/DOLMA-speech", lang_name, split=split)
+            sentences += dataset["sentence"] + dataset["english"]
+    return sentences
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num_sentences", type=int, default=100_000, help="Predictions (and references) per eval.")
+    parser.add_argument("--num_evals", type=int, default=3)
+    parser.add_argument("--languages", nargs="*", default=[], help="DOLMA-speech configs; synthetic text if unset.")
+    parser.add_argument("--pool_size", type=int, default=20_000, help="Distinct synthetic sentences.")
+    args = parser.parse_args()
+
+    pool = load_sentences(args)
+    rng = np.random.default_rng(0)
+    references = [pool[i] for i in rng.integers(0, len(pool), args.num_sentences)]
+    # predictions of a model that is right on half of the sentences, the other half is new every eval
+    evals = []
+    for i in range(args.num_evals):
+        predictions = [text if rng.random() < 0.5 else f"{text[: len(text) // 2]} {i}" for text in references]
+        evals.append(predictions + references)
+
+    uncached = preprocess_func.__wrapped__
+    start = time.perf_counter()
+    for texts in evals:
+        [uncached(text) for text in texts]
+    uncached_time = time.perf_counter() - start
+
+    preprocess_func.cache_clear()
+    cached_times = []
+    for texts in evals:
+        start = time.perf_counter()
+        preprocess_batch(texts)
+        cached_times.append(time.perf_counter() - start)
+    info = preprocess_func.cache_info()
+
+    total = sum(len(texts) for texts in evals)
+    print(f"{args.num_evals} evals of {args.num_sentences} predictions + references, {len(set(pool))} sentences")
+    print(f"{'normaliser':<22} {'seconds':>8} {'strings/s':>11}")
+    print(f"{'per string':<22} {uncached_time:>8.2f} {total / uncached_time:>11.0f}")
+    print(f"{'batch + LRU, all':<22} {sum(cached_times):>8.2f} {total / sum(cached_times):>11.0f}")
+    for i, seconds in enumerate(cached_times):
+        print(f"{f'batch + LRU, eval {i + 1}':<22} {seconds:>8.2f} {len(evals[i]) / seconds:>11.0f}")
+    print(f"cache: {info.hits} hits, {info.misses} misses, {info.currsize} entries")
+
+
+if __name__ == "__main__":
+    main()
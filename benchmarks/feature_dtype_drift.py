@@ -0,0 +1,86 @@
+"""Measure the WER/CER drift caused by storing the log-mel cache as float16 or int8 (`--feature_storage_dtype`).
+
+Every eval utterance is transcribed from its float32 features and from the features after a compress/decompress
+round trip, exactly as the data collator of finetune_whisper.py sees them:
+
+    python benchmarks/feature_dtype_drift.py --model_name_or_path ./whisper-base-me --max_eval_samples 100
+"""
+import argparse
+import os
+import sys
+
+import evaluate
+import numpy as np
+import torch
+from datasets import Audio, load_dataset
+from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from finetune_whisper import (  # noqa: E402
+    LANGUAGES,
+    compress_input_features,
+    decompress_input_features,
+    preprocess_batch,
+)
+
+DTYPES = ["float32", "float16", "int8"]
+
+
+def round_trip(input_features, dtype):
+    stored, scales = compress_input_features(input_features, dtype)
+    return np.stack(
+        [decompress_input_features(row, None if scales is None else scales[i]) for i, row in enumerate(stored)]
+    )
+
+
+@torch.no_grad()
+def transcribe(model, processor, input_features, lang_code, batch_size):
+    predictions = []
+    for start in range(0, len(input_features), batch_size):
+        batch = torch.from_numpy(input_features[start : start + batch_size]).to(model.device, model.dtype)
+        generated = model.generate(batch, language=lang_code, task="transcribe")
+        predictions += processor.batch_decode(generated, skip_special_tokens=True)
+    return preprocess_batch(predictions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model_name_or_path", required=True)
+    parser.add_argument("--languages", nargs="+", default=list(LANGUAGES))
+    parser.add_argument("--max_eval_samples", type=int, default=100, help="Utterances per language.")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--transcription_column_name", default="sentence")
+    args = parser.parse_args()
+
+    processor = AutoProcessor.from_pretrained(args.model_name_or_path)
+    model = AutoModelForSpeechSeq2Seq.from_pretrained(args.model_name_or_path).eval()
+    wer_metric = evaluate.load("wer")
+    cer_metric = evaluate.load("cer")
+
+    print(f"{'language':<18} {'dtype':<8} {'bytes/utt':>10} {'max |err|':>10} {'WER':>7} {'CER':>7} "
+          f"{'dWER':>7} {'dCER':>7}")
+    for lang_name in args.languages:
+        dataset = load_dataset("razhan/DOLMA-speech", lang_name, split="test")
+        dataset = dataset.select(range(min(args.max_eval_samples, len(dataset))))
+        dataset = dataset.cast_column("audio", Audio(sampling_rate=processor.feature_extractor.sampling_rate))
+        references = preprocess_batch(dataset[args.transcription_column_name])
+        input_features = processor.feature_extractor(
+            [sample["array"] for sample in dataset["audio"]], sampling_rate=processor.feature_extractor.sampling_rate
+        )["input_features"]
+
+        baseline = None
+        for dtype in DTYPES:
+            features = round_trip(input_features, dtype)
+            stored, scales = compress_input_features(input_features[:1], dtype)
+            nbytes = stored.nbytes + (0 if scales is None else scales.nbytes)
+            predictions = transcribe(model, processor, features, LANGUAGES[lang_name], args.batch_size)
+            wer = wer_metric.compute(predictions=predictions, references=references)
+            cer = cer_metric.compute(predictions=predictions, references=references)
+            if baseline is None:
+                baseline = (wer, cer)
+            print(f"{lang_name:<18} {dtype:<8} {nbytes:>10} {np.abs(features - input_features).max():>10.4f} "
+                  f"{wer:>7.4f} {cer:>7.4f} {wer - baseline[0]:>+7.4f} {cer - baseline[1]:>+7.4f}")
+
+
+if __name__ == "__main__":
+    main()
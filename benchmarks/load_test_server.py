@@ -0,0 +1,101 @@
+"""Load test of a running serve.py at increasing numbers of concurrent clients.
+
+Every client posts clips back to back. For every concurrency level the script reports the throughput, the p50/p99
+latency seen by the clients and the mean batch size of the server over the level (from `GET /metrics`):
+
+    python serve.py --model_name_or_path ./whisper-base-me --max_batch_size 16 --max_wait_ms 20 &
+    python benchmarks/load_test_server.py --url http://localhost:8000 --concurrency 1 2 4 8 16 32
+    python benchmarks/load_test_server.py --audio_dir dataset/hawrami --language hawrami
+
+Without `--audio_dir`, synthetic 2-8 second clips are posted.
+"""
+import argparse
+import asyncio
+import io
+import os
+import time
+
+import aiohttp
+import numpy as np
+import soundfile as sf
+
+
+def load_clips(args):
+    if args.audio_dir is None:
+        rng = np.random.default_rng(0)
+        clips = []
+        for _ in range(32):
+            array = rng.standard_normal(int(rng.uniform(2, 8) * 16000)).astype(np.float32) * 0.1
+            buffer = io.BytesIO()
+            sf.write(buffer, array, 16000, format="WAV")
+            clips.append(buffer.getvalue())
+        return clips
+    clips = []
+    for file_name in sorted(os.listdir(args.audio_dir)):
+        if file_name.lower().endswith((".mp3", ".wav", ".ogg", ".oga", ".opus", ".flac")):
+            with open(os.path.join(args.audio_dir, file_name), "rb") as f:
+                clips.append(f.read())
+    return clips
+
+
+async def run_level(session, args, clips, concurrency):
+    latencies = []
+    counter = iter(range(args.requests_per_level))
+    url = f"{args.url}/transcribe"
+    params = {"language": args.language, "task": args.task}
+
+    async def client():
+        for i in counter:
+            start = time.perf_counter()
+            async with session.post(url, params=params, data=clips[i % len(clips)]) as response:
+                response.raise_for_status()
+                await response.json()
+            latencies.append(time.perf_counter() - start)
+
+    async with session.get(f"{args.url}/metrics") as response:
+        before = await response.json()
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    async with session.get(f"{args.url}/metrics") as response:
+        after = await response.json()
+    batches = after["batches"] - before["batches"]
+    windows = after["mean_batch_size"] * after["batches"] - before["mean_batch_size"] * before["batches"]
+    return {
+        "throughput": len(latencies) / elapsed,
+        "p50": np.percentile(latencies, 50) * 1000,
+        "p99": np.percentile(latencies, 99) * 1000,
+        "mean_batch_size": windows / max(batches, 1),
+    }
+
+
+async def main_async(args):
+    clips = load_clips(args)
+    timeout = aiohttp.ClientTimeout(total=None)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        # warm up the model
+        await run_level(session, args, clips, 1)
+        print(f"{args.requests_per_level} requests per level, {len(clips)} distinct clips")
+        print(f"{'clients':>8} {'req/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'batch':>7}")
+        for concurrency in args.concurrency:
+            result = await run_level(session, args, clips, concurrency)
+            print(
+                f"{concurrency:>8} {result['throughput']:>8.2f} {result['p50']:>9.1f} {result['p99']:>9.1f} "
+                f"{result['mean_batch_size']:>7.2f}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--requests_per_level", type=int, default=64)
+    parser.add_argument("--audio_dir", default=None)
+    parser.add_argument("--language", default="hawrami")
+    parser.add_argument("--task", default="transcribe", choices=["transcribe", "translate"])
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
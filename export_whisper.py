@@ -0,0 +1,92 @@
+"""Export a checkpoint fine-tuned by finetune_whisper.py for inference on CPU.
+
+    python export_whisper.py --model_name_or_path ./whisper-base-me --format int8 --output_dir ./whisper-base-me-int8
+    python export_whisper.py --model_name_or_path ./whisper-base-me --format onnx --output_dir ./whisper-base-me-onnx
+
+Formats:
+- `int8`: the linear layers of the encoder and decoder dynamically quantised to int8 with PyTorch
+  (`torch.ao.quantization.quantize_dynamic`); weights are stored as int8 and activations are quantised on the fly.
+- `onnx`: ONNX encoder, decoder and decoder with KV cache, exported with optimum and run with onnxruntime.
+- `onnx_int8`: the same graphs with dynamically quantised int8 weights.
+
+The output directory also holds the processor, so transcribe.py and serve.py load it with `--model_name_or_path`
+like any other checkpoint. The ONNX formats need `pip install optimum-onnx[onnxruntime]`.
+"""
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+
+import torch
+from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor
+
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("int8", "onnx", "onnx_int8")
+INT8_WEIGHTS_NAME = "model_int8.pt"
+ONNX_FILE_NAMES = ("encoder_model.onnx", "decoder_model.onnx", "decoder_with_past_model.onnx")
+
+
+def quantize_dynamic_int8(model):
+    """`model` with its linear layers dynamically quantised to int8."""
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def export_int8(model_name_or_path, output_dir):
+    model = AutoModelForSpeechSeq2Seq.from_pretrained(model_name_or_path).eval()
+    model.config.save_pretrained(output_dir)
+    model.generation_config.save_pretrained(output_dir)
+    torch.save(quantize_dynamic_int8(model).state_dict(), os.path.join(output_dir, INT8_WEIGHTS_NAME))
+
+
+def export_onnx(model_name_or_path, output_dir, quantize=False):
+    from optimum.onnxruntime import ORTModelForSpeechSeq2Seq, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    model = ORTModelForSpeechSeq2Seq.from_pretrained(model_name_or_path, export=True, use_cache=True)
+    if not quantize:
+        model.save_pretrained(output_dir)
+        return
+    with tempfile.TemporaryDirectory() as onnx_dir:
+        model.save_pretrained(onnx_dir)
+        quantization_config = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+        for file_name in ONNX_FILE_NAMES:
+            quantizer = ORTQuantizer.from_pretrained(onnx_dir, file_name=file_name)
+            quantizer.quantize(save_dir=onnx_dir, quantization_config=quantization_config)
+            # keep the standard file names so that the directory loads without extra arguments
+            os.replace(
+                os.path.join(onnx_dir, file_name.replace(".onnx", "_quantized.onnx")),
+                os.path.join(output_dir, file_name),
+            )
+        for file_name in os.listdir(onnx_dir):
+            if file_name.endswith(".json"):
+                shutil.copy(os.path.join(onnx_dir, file_name), output_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model_name_or_path", required=True)
+    parser.add_argument("--output_dir", required=True)
+    parser.add_argument("--format", choices=FORMATS, required=True)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.format == "int8":
+        export_int8(args.model_name_or_path, args.output_dir)
+    else:
+        export_onnx(args.model_name_or_path, args.output_dir, quantize=args.format == "onnx_int8")
+    AutoProcessor.from_pretrained(args.model_name_or_path).save_pretrained(args.output_dir)
+
+    size = sum(
+        os.path.getsize(os.path.join(args.output_dir, file_name))
+        for file_name in os.listdir(args.output_dir)
+        if file_name.endswith((".pt", ".onnx", ".onnx_data"))
+    )
+    logger.info(f"Exported {args.model_name_or_path} as {args.format} to {args.output_dir} ({size / 2**20:.1f} MiB)")
+
+
+if __name__ == "__main__":
+    main()
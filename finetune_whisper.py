@@ -1,17 +1,29 @@
 """Here is my code I want to fine tune the model on both translation and transcription simultaneously. edit the code as necessary I am using a dataset called razhan/DOLMA-speech it can be loaded as the following load_dataset("razhan/DOLMA-speech", "hawrami", split="train") it has the following columns id,file_name,sentence,english,gender,language,original_full_path,duration,speaker_id
 
 No I want you to process each sample twice once for transcription once for translation in prepare dataset"""
+import functools
+import hashlib
+import inspect
+import json
 import logging
 import os
+import shutil
 import sys
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from typing import Any, Dict, List, Optional, Union
 import numpy as np
+import pyarrow as pa
 
 import datasets
-import evaluate
 import torch
+from tqdm import tqdm
 from datasets import DatasetDict, load_dataset
+from datasets.fingerprint import Hasher
+from rapidfuzz.distance import Levenshtein
+from sacrebleu.metrics import BLEU, CHRF
 
 import transformers
 from transformers import (
@@ -25,21 +37,45 @@ from transformers import (
     Seq2SeqTrainingArguments,
     set_seed,
 )
-from transformers.trainer_utils import get_last_checkpoint, is_main_process
+from transformers.trainer_pt_utils import LengthGroupedSampler
+from transformers.trainer_utils import get_last_checkpoint, is_main_process, seed_worker
+from transformers.utils import cached_file
 from transformers.models.whisper.english_normalizer import BasicTextNormalizer
 from klpt.preprocess import Preprocess
 
+from pcm_cache import PCMCache, audio_key
+from whisper_utils import LANGUAGES, AssistedGenerationStats, enable_encoder_length_buckets
+
 preprocessor_ckb = Preprocess("Sorani", "Arabic", numeral="Latin")
 normalizer = BasicTextNormalizer()
 
+# The same sentences are normalised as targets of both tasks and as references of every evaluation
+@functools.lru_cache(maxsize=2**18)
 def preprocess_func(text):
     text = preprocessor_ckb.unify_numerals(text)
     text = normalizer(text)
     return text
 
 
+def preprocess_batch(texts):
+    """Normalises a list of strings with `preprocess_func`, every distinct string once."""
+    normalized = {text: preprocess_func(text) for text in dict.fromkeys(texts)}
+    return [normalized[text] for text in texts]
+
+
 logger = logging.getLogger(__name__)
 
+# Bump when the layout of the stored features changes, so that old feature stores are no longer attached to
+FEATURE_STORE_VERSION = 1
+
+# silence between the utterances of a packed training example, see `pack_task_index`
+PACKING_GAP_SECONDS = 0.3
+
+# corpus-level scorers of the translation metrics, see `text_metric_counts`. Their statistics are extracted and
+# aggregated with private methods of sacrebleu 2, which requirements.txt pins
+BLEU_METRIC = BLEU()
+CHRF_METRIC = CHRF()
+
 
 @dataclass
 class ModelArguments:
@@ -115,6 +151,64 @@ class ModelArguments:
             "help": "Whether to apply *SpecAugment* data augmentation to the input features. This is currently only relevant for Wav2Vec2, HuBERT, WavLM and Whisper models."
         },
     )
+    assistant_model_name_or_path: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Draft model for assisted generation in evaluation, e.g. a whisper-tiny fine-tuned with this script "
+                "on the same languages. It drafts tokens that the model checks in a single forward pass, so the "
+                "greedy predictions are unchanged. Assisted generation runs one utterance at a time."
+            )
+        },
+    )
+    teacher_model_name_or_path: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Fine-tuned checkpoint (e.g. a whisper-base or larger trained with this script) to distil into the "
+                "model being trained, e.g. whisper-tiny. The top `distillation_top_k` teacher logits at every label "
+                "position of the training set are computed once and kept in the datasets cache."
+            )
+        },
+    )
+    student_decoder_layers: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Keep only this many decoder layers of the model, evenly spaced and including the first and the "
+                "last one, to train a student with a shallower decoder."
+            )
+        },
+    )
+    distillation_top_k: int = field(
+        default=32, metadata={"help": "Number of teacher logits cached per label position."}
+    )
+    distillation_temperature: float = field(
+        default=2.0, metadata={"help": "Softmax temperature of the teacher and student distributions."}
+    )
+    lora_rank: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Train low-rank adapters (LoRA) of this rank on the `lora_target_modules` of the encoder and decoder "
+                "instead of all weights. Checkpoints then hold the adapter weights only. Needs `peft`."
+            )
+        },
+    )
+    lora_alpha: Optional[float] = field(
+        default=None, metadata={"help": "Scaling numerator of the LoRA updates, twice `lora_rank` by default."}
+    )
+    lora_dropout: float = field(default=0.05, metadata={"help": "Dropout on the inputs of the LoRA adapters."})
+    lora_target_modules: str = field(
+        default="q_proj,k_proj,v_proj,out_proj,fc1,fc2",
+        metadata={"help": "Comma separated names of the attention and MLP projections that get LoRA adapters."},
+    )
+    distillation_kl_weight: float = field(
+        default=0.5,
+        metadata={
+            "help": "Weight of the KL divergence to the teacher in the training loss, the label loss gets the rest."
+        },
+    )
 
 
 @dataclass
@@ -129,6 +223,19 @@ class DataTrainingArguments:
     dataset_config_name: Optional[str] = field(
         default=None, metadata={"help": "The configuration name of the dataset to use (via the datasets library)."}
     )
+    dataset_revision: Optional[str] = field(
+        default=None,
+        metadata={"help": "The specific dataset version to use (can be a branch name, tag name or commit id)."},
+    )
+    language_names: Optional[List[str]] = field(
+        default=None,
+        metadata={
+            "help": (
+                "DOLMA-speech configs to train and evaluate on, e.g. `hawrami gilaki`; all languages by default. "
+                "Train one LoRA adapter per language with a single name."
+            )
+        },
+    )
     overwrite_cache: bool = field(
         default=False, metadata={"help": "Overwrite the cached training and evaluation sets"}
     )
@@ -136,6 +243,14 @@ class DataTrainingArguments:
         default=None,
         metadata={"help": "The number of processes to use for the preprocessing."},
     )
+    preprocessing_batch_size: int = field(
+        default=64,
+        metadata={
+            "help": (
+                "Number of utterances turned into log-mel features and tokenized together in one preprocessing call."
+            )
+        },
+    )
     max_train_samples: Optional[int] = field(
         default=None,
         metadata={
@@ -170,14 +285,146 @@ class DataTrainingArguments:
         default=20.0,
         metadata={
             "help": (
-                "Truncate audio files that are longer than `max_duration_in_seconds` seconds to"
-                " 'max_duration_in_seconds`"
+                "Filter audio files that are longer than `max_duration_in_seconds` seconds. Applied on the"
+                " `duration` column before decoding"
             )
         },
     )
     min_duration_in_seconds: float = field(
         default=0.0, metadata={"help": "Filter audio files that are shorter than `min_duration_in_seconds` seconds"}
     )
+    feature_storage_dtype: str = field(
+        default="float32",
+        metadata={
+            "help": (
+                "Storage type of the cached log-mel input features: `float32`, `float16` or `int8` (quantised with "
+                "one scale per mel bin). The data collator upcasts them to float32 on the fly."
+            )
+        },
+    )
+    feature_store_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Directory of a persistent feature store. Log-mel features are saved there once per feature "
+                "extractor config, storage type and source data, and later runs (e.g. with other model sizes or "
+                "learning rates) attach to them memory-mapped instead of recomputing them."
+            )
+        },
+    )
+    pcm_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Directory of a pre-decoded audio cache (see `pcm_cache.py`). Every clip is decoded and resampled "
+                "to 16 kHz int16 PCM once and later read as a memory-mapped slice, both when extracting features "
+                "and with `--streaming_features`. Clips missing from the cache are decoded and added first."
+            )
+        },
+    )
+    streaming_features: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether to compute the log-mel input features on the fly in the data collator instead of caching "
+                "them during preprocessing. Only the audio is kept on disk, at the cost of extra CPU work in the "
+                "dataloader workers (see `--dataloader_num_workers`). Requires a `duration` column."
+            )
+        },
+    )
+    encoder_length_buckets: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Comma-separated input durations in seconds, e.g. `10,20,30`. Instead of padding every batch to 30 "
+                "seconds of mel frames, the data collator trims it to the shortest bucket that holds its longest "
+                "utterance and the encoder positional embeddings are sliced to match, in training and in evaluation "
+                "`generate`. Training batches are grouped by length (`--group_by_length`). A 30 second bucket is "
+                "always added, so no audio is cut."
+            )
+        },
+    )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Build training batches of examples with similar label and input lengths up to this budget of "
+                "padded target tokens (number of examples times the longest labels), instead of random batches "
+                "of `per_device_train_batch_size`, which still caps the number of examples per batch. The batches "
+                "are shuffled every epoch and are the same on every process."
+            )
+        },
+    )
+    pack_utterances: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether to pack several training utterances of the same language and task into one 30 second "
+                "window, with short silences between them and their targets joined by a space. Evaluation stays "
+                "on single utterances. Not supported with `--streaming_features` or `--share_encoder_across_tasks`."
+            )
+        },
+    )
+    share_encoder_across_tasks: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether to train on one batch element per utterance carrying both its transcription and its "
+                "translation labels. The encoder runs once per utterance and the decoder runs on both label "
+                "sequences against its output, which halves the encoder compute per epoch. A batch then holds "
+                "twice as many target sequences, so halve `per_device_train_batch_size` to keep the same number "
+                "of targets per step. Evaluation is unchanged."
+            )
+        },
+    )
+    sort_eval_by_length: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether to evaluate in batches of rows sorted by duration and label length, longest first, so "
+                "that short clips are not generated in the same batch as the longest ones."
+            )
+        },
+    )
+    eval_max_new_tokens_per_second: Optional[float] = field(
+        default=None,
+        metadata={
+            "help": (
+                "If set, caps the tokens generated for every evaluation batch at this many per second of its "
+                "longest clip instead of `generation_max_length`. The share of eval references longer than the "
+                "cap is logged at startup."
+            )
+        },
+    )
+    eval_prediction_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Directory caching the generated evaluation predictions by checkpoint, generation settings (with the "
+                "token cap of every batch), input features and task. Evaluating an unchanged checkpoint again, e.g. "
+                "with other metrics, reuses them instead of generating."
+            )
+        },
+    )
+    teacher_forced_eval: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether evaluations during training run one teacher-forced forward pass instead of generating. "
+                "They report the loss, token accuracy and CER of every language and task, e.g. `eval_hawrami_"
+                "transcribe_cer`. The evaluation after training still generates and reports WER/CER/BLEU/chrF."
+            )
+        },
+    )
+    generate_eval_steps: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": (
+                "With `--teacher_forced_eval`, evaluations at global steps that are a multiple of this number "
+                "generate anyway. Should be a multiple of `eval_steps`."
+            )
+        },
+    )
     preprocessing_only: bool = field(
         default=False,
         metadata={
@@ -220,6 +467,49 @@ class DataTrainingArguments:
     )
 
 
+def build_prefix_table(tokenizer, lang_codes, tasks=("transcribe", "translate")):
+    """
+    Returns the label prefix `<|startoftranscript|><|lang|><|task|><|notimestamps|>` of every (language code, task)
+    pair as token ids, looked up in the vocabulary of a Whisper tokenizer without changing its prefix tokens.
+    """
+    prefix_ids = {}
+    for lang_code in lang_codes:
+        for task in tasks:
+            tokens = ["<|startoftranscript|>", f"<|{lang_code}|>", f"<|{task}|>", "<|notimestamps|>"]
+            ids = tokenizer.convert_tokens_to_ids(tokens)
+            if tokenizer.unk_token_id in ids:
+                raise ValueError(f"The tokenizer has no special token for one of {tokens}.")
+            prefix_ids[(lang_code, task)] = ids
+    return prefix_ids
+
+
+def compress_input_features(input_features, dtype):
+    """
+    Compresses a batch of log-mel features of shape `(batch_size, num_mel_bins, num_frames)` for storage in the
+    datasets cache. With `int8` every mel bin is quantised symmetrically with its own scale; the scales, of shape
+    `(batch_size, num_mel_bins)`, are returned as second value (`None` for the float types).
+    """
+    input_features = np.asarray(input_features, dtype=np.float32)
+    if dtype == "float32":
+        return input_features, None
+    if dtype == "float16":
+        return input_features.astype(np.float16), None
+    if dtype == "int8":
+        scales = np.abs(input_features).max(axis=-1, keepdims=True) / 127.0
+        scales[scales == 0] = 1.0
+        quantized = np.clip(np.rint(input_features / scales), -127, 127).astype(np.int8)
+        return quantized, scales[..., 0]
+    raise ValueError(f"Unsupported feature storage dtype {dtype}, expected one of `float32`, `float16` or `int8`.")
+
+
+def decompress_input_features(input_features, scales=None):
+    """Upcasts the stored log-mel features of one utterance back to float32, undoing the int8 scaling if needed."""
+    input_features = np.asarray(input_features, dtype=np.float32)
+    if scales is not None:
+        input_features = input_features * np.asarray(scales, dtype=np.float32)[:, None]
+    return input_features
+
+
 @dataclass
 class DataCollatorSpeechSeq2SeqWithPadding:
     """
@@ -231,23 +521,56 @@ class DataCollatorSpeechSeq2SeqWithPadding:
             The begin-of-sentence of the decoder.
         forward_attention_mask (`bool`)
             Whether to return attention_mask.
+        frame_buckets (`List[int]`, *optional*)
+            Sorted numbers of mel frames the padded input features are trimmed to, see `--encoder_length_buckets`.
+            The batch is trimmed to the smallest bucket that holds the `input_length` of all its examples.
+        return_input_length (`bool`, *optional*, defaults to `False`)
+            Whether to return the `input_length` of the examples, e.g. to cap generation by duration.
     """
 
     processor: Any
     decoder_start_token_id: int
     forward_attention_mask: bool
+    frame_buckets: Optional[List[int]] = None
+    return_input_length: bool = False
 
     def __call__(self, features: List[Dict[str, Union[List[int], torch.Tensor]]]) -> Dict[str, torch.Tensor]:
         # split inputs and labels since they have to be of different lengths and need
         # different padding methods
-        input_features = [{"input_features": feature["input_features"]} for feature in features]  
-        label_features = [{"input_ids": feature["labels"]} for feature in features]
-
+        # cached features may be stored as float16 or int8, so upcast them here
+        input_features = [
+            {
+                "input_features": decompress_input_features(
+                    feature["input_features"], feature.get("input_features_scale")
+                )
+            }
+            for feature in features
+        ]
         batch = self.processor.feature_extractor.pad(input_features, return_tensors="pt")
 
         if self.forward_attention_mask:
             batch["attention_mask"] = torch.LongTensor([feature["attention_mask"] for feature in features])
 
+        if self.frame_buckets is not None:
+            bucket = self.select_frame_bucket(features)
+            batch["input_features"] = batch["input_features"][..., :bucket]
+            if self.forward_attention_mask:
+                batch["attention_mask"] = batch["attention_mask"][:, :bucket]
+
+        batch["labels"] = self.pad_labels([feature["labels"] for feature in features])
+
+        if self.return_input_length:
+            batch["input_length"] = torch.LongTensor([feature["input_length"] for feature in features])
+
+        return batch
+
+    def select_frame_bucket(self, features: List[Dict[str, Any]]) -> int:
+        hop_length = self.processor.feature_extractor.hop_length
+        num_frames = max(-(-feature["input_length"] // hop_length) for feature in features)
+        return next(frames for frames in self.frame_buckets if frames >= num_frames)
+
+    def pad_labels(self, labels: List[List[int]]) -> torch.Tensor:
+        label_features = [{"input_ids": feature} for feature in labels]
         labels_batch = self.processor.tokenizer.pad(label_features, return_tensors="pt")
 
         # replace padding with -100 to ignore loss correctly
@@ -258,11 +581,1007 @@ class DataCollatorSpeechSeq2SeqWithPadding:
         if (labels[:, 0] == self.decoder_start_token_id).all().cpu().item():
             labels = labels[:, 1:]
 
-        batch["labels"] = labels
+        return labels
+
+
+@dataclass
+class DataCollatorSpeechSeq2SeqWithFeatureExtraction(DataCollatorSpeechSeq2SeqWithPadding):
+    """
+    Data collator that computes the log-mel input features of a batch of raw audio on the fly before padding it.
+    Used with `--streaming_features`, so that feature extraction runs in the dataloader workers instead of being
+    materialised in the datasets cache.
+    Args:
+        audio_column_name (`str`)
+            The name of the feature column holding the decoded audio, or the PCM cache keys.
+        pcm_cache ([`PCMCache`], *optional*)
+            Pre-decoded audio cache to read the clips from, by the keys in `audio_column_name`.
+    """
+
+    audio_column_name: str = "audio"
+    pcm_cache: Optional[PCMCache] = None
+
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        samples = [feature[self.audio_column_name] for feature in features]
+        if self.pcm_cache is not None:
+            arrays = [self.pcm_cache.load(key) for key in samples]
+            sampling_rate = self.pcm_cache.sampling_rate
+        else:
+            arrays = [sample["array"] for sample in samples]
+            sampling_rate = samples[0]["sampling_rate"]
+        inputs = self.processor.feature_extractor(
+            arrays, sampling_rate=sampling_rate, return_attention_mask=self.forward_attention_mask
+        )
+        features = [
+            {
+                "input_features": inputs["input_features"][i],
+                "labels": feature["labels"],
+                "input_length": feature["input_length"],
+                **({"attention_mask": inputs["attention_mask"][i]} if self.forward_attention_mask else {}),
+            }
+            for i, feature in enumerate(features)
+        ]
+        return super().__call__(features)
+
+
+def filter_by_duration(dataset, min_duration, max_duration):
+    """
+    Keeps the rows whose `duration` column lies strictly between `min_duration` and `max_duration` seconds. Only
+    the `duration` column is read, so skipped clips are never decoded. Returns the filtered dataset together with
+    the number of skipped rows and their total duration in seconds.
+    """
+    durations = np.asarray(dataset["duration"], dtype=np.float64)
+    keep = (durations > min_duration) & (durations < max_duration)
+    skipped_seconds = float(durations[~keep].sum())
+    return dataset.select(np.flatnonzero(keep)), int((~keep).sum()), skipped_seconds
+
+
+def load_language_split(
+    dataset_name,
+    lang_name,
+    lang_code,
+    split,
+    min_duration,
+    max_duration,
+    max_samples=None,
+    cache_dir=None,
+    revision=None,
+):
+    """
+    Loads one split of a DOLMA-speech language config with row indices as `id` and the Whisper language code as
+    `language`. Clips outside the duration range are dropped before `max_samples` is applied. Columns are replaced
+    without a `map`, with fingerprints derived from the loaded data and the arguments, so the datasets cache is hit
+    on every rerun. Returns the dataset together with the skipped rows and seconds of `filter_by_duration`.
+    """
+    dataset = load_dataset(dataset_name, lang_name, split=split, cache_dir=cache_dir, revision=revision)
+    # Replace the id column with row indices of a consistent type and the language with its Whisper code
+    dataset = dataset.remove_columns([column for column in ("id", "language") if column in dataset.column_names])
+    dataset = dataset.add_column(
+        "id", list(range(len(dataset))), new_fingerprint=Hasher.hash((dataset._fingerprint, "id"))
+    )
+    dataset = dataset.add_column(
+        "language", [lang_code] * len(dataset), new_fingerprint=Hasher.hash((dataset._fingerprint, lang_code))
+    )
+
+    # Drop clips outside the duration range before anything is decoded
+    dataset, skipped_rows, skipped_seconds = filter_by_duration(dataset, min_duration, max_duration)
+
+    if max_samples is not None:
+        dataset = dataset.select(range(min(len(dataset), max_samples)))
+    return dataset, skipped_rows, skipped_seconds
+
+
+def load_or_build_feature_store(store_dir, key, build_fn, metadata):
+    """
+    Attaches to the features stored under `store_dir/key`, building them first with `build_fn` if they are missing.
+    `build_fn` receives a cache file next to the store to write the features to, so that they never have to fit into
+    memory; it is deleted once they are saved. The store is saved with `save_to_disk` and loaded back memory-mapped,
+    so attaching to it copies nothing. It is moved into place in a single rename, so concurrent runs never see a
+    half-written store.
+    """
+    path = os.path.join(store_dir, key)
+    if not os.path.isdir(path):
+        os.makedirs(store_dir, exist_ok=True)
+        build_dir = tempfile.mkdtemp(prefix=f".{key}-", dir=store_dir)
+        try:
+            features = build_fn(os.path.join(build_dir, "features.arrow"))
+            features.save_to_disk(os.path.join(build_dir, "store"))
+            with open(os.path.join(build_dir, "store", "feature_store.json"), "w") as f:
+                json.dump(metadata, f, indent=2)
+            os.replace(os.path.join(build_dir, "store"), path)
+            logger.info(f"Saved features to the feature store at {path}")
+        except OSError:
+            # another run built the same store in the meantime
+            if not os.path.isdir(path):
+                raise
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+    else:
+        logger.info(f"Attaching to the feature store at {path}")
+    return datasets.load_from_disk(path)
+
+
+@dataclass
+class DataCollatorSpeechSeq2SeqWithStacking(DataCollatorSpeechSeq2SeqWithPadding):
+    """
+    Data collator for cached input features of a fixed number of frames, such as the read-only NumPy views into the
+    Arrow cache returned by [`MultiTaskSpeechDataset`] with `numpy_views=True`. The features of a batch are upcast and
+    stacked with a single copy into a new array, and labels and attention masks are padded in NumPy, so no batch goes
+    through nested Python lists. The returned tensors own their memory and can be pinned.
+    """
+
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        num_mel_bins, num_frames = features[0]["input_features"].shape
+        if self.frame_buckets is not None:
+            num_frames = self.select_frame_bucket(features)
+
+        input_features = np.empty((len(features), num_mel_bins, num_frames), dtype=np.float32)
+        for stacked, feature in zip(input_features, features):
+            stored = feature["input_features"][:, :num_frames]
+            scales = feature.get("input_features_scale")
+            if scales is None:
+                stacked[...] = stored
+            else:
+                np.multiply(stored, np.asarray(scales, dtype=np.float32)[:, None], out=stacked)
+        batch = {"input_features": torch.from_numpy(input_features)}
+
+        if self.forward_attention_mask:
+            attention_mask = np.stack([feature["attention_mask"][:num_frames] for feature in features])
+            batch["attention_mask"] = torch.from_numpy(attention_mask.astype(np.int64))
+
+        batch["labels"] = self.pad_labels([feature["labels"] for feature in features])
+        if self.return_input_length:
+            batch["input_length"] = torch.from_numpy(np.array([feature["input_length"] for feature in features]))
+        return batch
+
+    def pad_labels(self, labels: List[List[int]]) -> torch.Tensor:
+        padded = np.full((len(labels), max(len(label) for label in labels)), -100, dtype=np.int64)
+        for row, label in zip(padded, labels):
+            row[: len(label)] = label
+        # cut the bos token, it's appended later anyways
+        if (padded[:, 0] == self.decoder_start_token_id).all():
+            padded = np.ascontiguousarray(padded[:, 1:])
+        return torch.from_numpy(padded)
+
+
+@dataclass
+class DataCollatorSpeechSeq2SeqMultiTask:
+    """
+    Data collator for `--share_encoder_across_tasks`: every example is one utterance carrying the labels of both
+    tasks. The input features are collated once by `collator` with the transcription labels as `labels`, and the
+    translation labels are padded alongside as `labels_translate`. Examples with a single `labels` column (the
+    evaluation set) are passed to `collator` unchanged.
+    Args:
+        collator ([`DataCollatorSpeechSeq2SeqWithPadding`])
+            The single-task data collator.
+    """
+
+    collator: DataCollatorSpeechSeq2SeqWithPadding
+
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        if "labels_transcribe" not in features[0]:
+            return self.collator(features)
+        batch = self.collator([{**feature, "labels": feature["labels_transcribe"]} for feature in features])
+        batch["labels_translate"] = self.collator.pad_labels([feature["labels_translate"] for feature in features])
+        return batch
+
+
+@dataclass
+class DataCollatorWithTeacherLogits:
+    """
+    Data collator for `--teacher_model_name_or_path`: the cached top-k teacher logits and token ids of every example
+    (see `compute_teacher_top_k`) are padded to the collated labels of `collator` as `teacher_top_k_logits` and
+    `teacher_top_k_ids`. Examples without them (the evaluation set) are passed to `collator` unchanged.
+    Args:
+        collator ([`DataCollatorSpeechSeq2SeqWithPadding`])
+            The data collator of the examples.
+    """
 
+    collator: DataCollatorSpeechSeq2SeqWithPadding
+
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        batch = self.collator(features)
+        if "teacher_top_k_ids" not in features[0]:
+            return batch
+        num_positions = batch["labels"].shape[1]
+        top_k = len(features[0]["teacher_top_k_ids"][0])
+        teacher_ids = np.zeros((len(features), num_positions, top_k), dtype=np.int64)
+        teacher_logits = np.zeros((len(features), num_positions, top_k), dtype=np.float32)
+        for i, feature in enumerate(features):
+            num_labels = len(feature["teacher_top_k_ids"])
+            teacher_ids[i, :num_labels] = feature["teacher_top_k_ids"]
+            teacher_logits[i, :num_labels] = feature["teacher_top_k_logits"]
+        batch["teacher_top_k_ids"] = torch.from_numpy(teacher_ids)
+        batch["teacher_top_k_logits"] = torch.from_numpy(teacher_logits)
         return batch
 
 
+class TokenBudgetBatchSampler:
+    """
+    Batch sampler for `--max_tokens_per_batch`. The examples are sorted by label length and input length (ties
+    broken at random with `seed`) and cut into batches of at most `max_batch_size` examples whose padded labels hold
+    at most `max_tokens` tokens. Only the order of the batches changes between epochs, seeded by `seed` and the
+    epoch passed to `set_epoch`, so every process of a distributed run draws the same batches and accelerate can
+    shard them, and a resumed run skips the batches it has already trained on.
+    Args:
+        label_lengths (`List[int]`)
+            The number of label tokens of every example.
+        input_lengths (`List[int]`)
+            The number of audio samples of every example.
+        max_tokens (`int`)
+            The budget of padded label tokens per batch.
+        max_batch_size (`int`)
+            The maximum number of examples per batch.
+        seed (`int`)
+            Seed of the tie breaking and the batch order.
+    """
+
+    def __init__(self, label_lengths, input_lengths, max_tokens, max_batch_size, seed=0):
+        self.seed = seed
+        self.epoch = 0
+        tie_breaker = np.random.default_rng(seed).permutation(len(label_lengths))
+        order = np.lexsort((tie_breaker, input_lengths, label_lengths))
+        self.batches = []
+        batch, longest = [], 0
+        for idx in order.tolist():
+            padded_length = max(longest, label_lengths[idx])
+            if batch and (len(batch) == max_batch_size or (len(batch) + 1) * padded_length > max_tokens):
+                self.batches.append(batch)
+                batch, padded_length = [], label_lengths[idx]
+            batch.append(idx)
+            longest = padded_length
+        if batch:
+            self.batches.append(batch)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        order = np.random.default_rng((self.seed, self.epoch)).permutation(len(self.batches))
+        for idx in order:
+            yield self.batches[idx]
+
+
+def label_padding_ratio(batches, label_lengths):
+    """Share of padding in the label tensors of `batches`, lists of example indices."""
+    padded = sum(len(batch) * max(label_lengths[idx] for idx in batch) for batch in batches)
+    return 1 - sum(label_lengths[idx] for batch in batches for idx in batch) / padded
+
+
+def enable_input_require_grads(model):
+    """
+    Makes the inputs of the encoder and decoder layers of `model` require grad, for LoRA with gradient checkpointing
+    (`--lora_rank`). A reentrant checkpointed layer only backpropagates into its weights, e.g. its adapters, if one
+    of its inputs requires grad, which the outputs of the frozen token embeddings and convolutions do not.
+    Older versions of `enable_input_require_grads` of transformers only hook the decoder token embeddings.
+    """
+    model.enable_input_require_grads()
+
+    def make_output_require_grad(module, args, output):
+        output.requires_grad_(True)
+
+    model.get_encoder().conv2.register_forward_hook(make_output_require_grad)
+
+
+def keep_decoder_layers(model, num_layers):
+    """
+    Shrinks the decoder of `model` to `num_layers` of its layers, evenly spaced and including the first and the last
+    one (`--student_decoder_layers`), and updates its config to match.
+    """
+    decoder = model.get_decoder()
+    keep = np.unique(np.linspace(0, len(decoder.layers) - 1, num_layers).round().astype(int))
+    decoder.layers = torch.nn.ModuleList([decoder.layers[i] for i in keep])
+    for layer_idx, layer in enumerate(decoder.layers):
+        # the key/value cache is indexed by layer
+        layer.self_attn.layer_idx = layer_idx
+        layer.encoder_attn.layer_idx = layer_idx
+    model.config.decoder_layers = len(keep)
+    logger.info(f"Kept decoder layers {keep.tolist()} of the model")
+
+
+@torch.no_grad()
+def compute_teacher_top_k(teacher, dataset, indices, data_collator, top_k):
+    """
+    Top `top_k` logits and token ids of `teacher`, teacher-forced on the labels, for the examples `indices` of
+    `dataset` (a [`MultiTaskSpeechDataset`]). Rows hold one entry per label position of the labels collated by
+    `data_collator`, for [`DataCollatorWithTeacherLogits`].
+    """
+    batch = data_collator([dataset[i] for i in indices])
+    labels = batch["labels"].to(teacher.device)
+    logits = teacher(
+        input_features=batch["input_features"].to(teacher.device, dtype=teacher.dtype),
+        attention_mask=batch["attention_mask"].to(teacher.device) if "attention_mask" in batch else None,
+        labels=labels,
+    ).logits
+    values, ids = logits.float().topk(top_k, dim=-1)
+    num_labels = labels.ne(-100).sum(-1).tolist()
+    return {
+        "teacher_top_k_ids": [row[:n].tolist() for row, n in zip(ids.cpu(), num_labels)],
+        "teacher_top_k_logits": [row[:n].tolist() for row, n in zip(values.cpu(), num_labels)],
+    }
+
+
+def distillation_kl(logits, labels, teacher_ids, teacher_logits, temperature):
+    """
+    KL divergence from the teacher to the student at the label positions, between their distributions over the
+    cached top-k tokens of the teacher, scaled by the squared temperature so that its gradients keep their size
+    across temperatures.
+    """
+    mask = labels.ne(-100)
+    teacher_log_probs = torch.log_softmax(teacher_logits.float() / temperature, dim=-1)
+    student_log_probs = torch.log_softmax(logits.float().gather(-1, teacher_ids) / temperature, dim=-1)
+    kl = (teacher_log_probs.exp() * (teacher_log_probs - student_log_probs)).sum(-1)
+    return (kl * mask).sum() / mask.sum().clamp(min=1) * temperature**2
+
+
+def checkpoint_digest(model):
+    """Hash of the names and values of all weights of `model`."""
+    digest = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().reshape(-1).contiguous().view(torch.uint8).cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def checkpoint_signature(model_name_or_path, **kwargs):
+    """
+    Identifies the checkpoint `model_name_or_path` without loading its weights: the names, sizes and modification
+    times of the files of a local directory, or the commit of the snapshot of a checkpoint on the Hub, resolved
+    with `kwargs` (e.g. `cache_dir` and `token`) as `from_pretrained` does.
+    """
+    if os.path.isdir(model_name_or_path):
+        files = []
+        for name in sorted(os.listdir(model_name_or_path)):
+            path = os.path.join(model_name_or_path, name)
+            if os.path.isfile(path):
+                files.append((name, os.path.getsize(path), os.stat(path).st_mtime_ns))
+        return Hasher.hash((os.path.abspath(model_name_or_path), files))
+    config_file = cached_file(model_name_or_path, "config.json", **kwargs)
+    # the files of a Hub checkpoint are cached under `snapshots/<commit>/`
+    return Hasher.hash((model_name_or_path, os.path.basename(os.path.dirname(config_file))))
+
+
+class PredictionCache:
+    """
+    Generated evaluation predictions of one checkpoint (`--eval_prediction_cache_dir`). Every process appends the
+    rows it generates to its own JSON lines file in the directory of the checkpoint signature and reads those of
+    all processes.
+    Args:
+        cache_dir (`str`)
+            Root directory of the cache.
+        signature (`str`)
+            Hash of the checkpoint weights and the generation settings, see [`MultiTaskSeq2SeqTrainer.evaluate`].
+        process_index (`int`)
+            Index of the process writing to the cache.
+    """
+
+    def __init__(self, cache_dir, signature, process_index=0):
+        self.path = os.path.join(cache_dir, signature)
+        os.makedirs(self.path, exist_ok=True)
+        self.predictions = {}
+        for file_name in sorted(os.listdir(self.path)):
+            with open(os.path.join(self.path, file_name)) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # last line of an interrupted evaluation
+                        continue
+                    self.predictions[entry["key"]] = entry["tokens"]
+        self._file = open(os.path.join(self.path, f"predictions-{process_index:05d}.jsonl"), "a")
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def row_keys(input_features, labels, max_new_tokens=None):
+        """
+        Keys of the rows of a batch: a hash of their input features, their language and task tokens and the
+        `max_new_tokens` they are generated with, which `--eval_max_new_tokens_per_second` sets per batch.
+        """
+        input_features = input_features.detach().cpu().numpy()
+        prefixes = labels[:, :2].detach().cpu().numpy()
+        cap = str(max_new_tokens).encode()
+        return [
+            hashlib.sha1(features.tobytes() + prefix.tobytes() + cap).hexdigest()
+            for features, prefix in zip(input_features, prefixes)
+        ]
+
+    def get(self, keys):
+        """Returns the cached token ids of all `keys`, or `None` if any of them is missing."""
+        if all(key in self.predictions for key in keys):
+            self.hits += len(keys)
+            return [self.predictions[key] for key in keys]
+        self.misses += len(keys)
+        return None
+
+    def add(self, keys, tokens):
+        for key, row in zip(keys, tokens):
+            self.predictions[key] = row
+            self._file.write(json.dumps({"key": key, "tokens": row}))
+            self._file.write("\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class MultiTaskSeq2SeqTrainer(Seq2SeqTrainer):
+    """
+    Seq2SeqTrainer for the datasets and data collators of this script.
+    - Batches of [`DataCollatorSpeechSeq2SeqMultiTask`] run the encoder once per utterance and the decoder on the
+      transcription and the translation labels against the shared `encoder_outputs`.
+    - `generate` runs on the mel frames of the batch as they are, instead of padding them back to 30 seconds.
+    - `--group_by_length` takes the lengths from the `input_length` index column of [`MultiTaskSpeechDataset`].
+    - With `max_tokens_per_batch`, training batches come from a [`TokenBudgetBatchSampler`].
+    - With `sort_eval_by_length`, evaluation batches hold rows of similar duration and label length.
+    - With `max_new_tokens_per_second`, `generate` stops after a number of tokens proportional to the duration of
+      the longest clip of the batch, read from its `input_length`.
+    - With `prediction_cache_dir`, generated predictions are reused from a [`PredictionCache`].
+    - Training batches with cached teacher logits ([`DataCollatorWithTeacherLogits`]) are trained on the label loss
+      mixed with the KL divergence to the teacher, weighted by `distillation_kl_weight`.
+    - With `assistant_model`, `generate` drafts tokens with that smaller model, one utterance at a time, and the
+      evaluation reports the share of drafted tokens that were accepted ([`AssistedGenerationStats`]).
+    - With `teacher_forced_metrics`, evaluations during training run a single forward pass over the labels instead
+      of `generate` and are scored by `teacher_forced_metrics` on the logits reduced by
+      `teacher_forced_preprocess_logits`, except at multiples of `generate_eval_steps`. Evaluations after training
+      always generate.
+    """
+
+    def __init__(
+        self,
+        *args,
+        max_tokens_per_batch=None,
+        sort_eval_by_length=False,
+        max_new_tokens_per_second=None,
+        prediction_cache_dir=None,
+        teacher_forced_metrics=None,
+        teacher_forced_preprocess_logits=None,
+        generate_eval_steps=None,
+        assistant_model=None,
+        distillation_kl_weight=0.5,
+        distillation_temperature=2.0,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.assistant_model = assistant_model.to(self.args.device).eval() if assistant_model is not None else None
+        self.assisted_stats = AssistedGenerationStats() if assistant_model is not None else None
+        self.distillation_kl_weight = distillation_kl_weight
+        self.distillation_temperature = distillation_temperature
+        self.teacher_forced_metrics = teacher_forced_metrics
+        self.teacher_forced_preprocess_logits = teacher_forced_preprocess_logits
+        self.generate_eval_steps = generate_eval_steps
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.sort_eval_by_length = sort_eval_by_length
+        self.max_new_tokens_per_second = max_new_tokens_per_second
+        self.prediction_cache_dir = prediction_cache_dir
+        self._prediction_cache = None
+
+    def get_train_dataloader(self):
+        if self.max_tokens_per_batch is None:
+            return super().get_train_dataloader()
+        label_lengths = self.train_dataset.label_lengths
+        batch_sampler = TokenBudgetBatchSampler(
+            label_lengths,
+            self.train_dataset.lengths,
+            max_tokens=self.max_tokens_per_batch,
+            max_batch_size=self.args.per_device_train_batch_size,
+            seed=self.args.seed,
+        )
+        batch_size = self.args.per_device_train_batch_size
+        random_batches = np.array_split(
+            np.random.default_rng(self.args.seed).permutation(len(label_lengths)),
+            range(batch_size, len(label_lengths), batch_size),
+        )
+        logger.info(
+            f"Token budget batching: {len(batch_sampler)} batches of {len(label_lengths) / len(batch_sampler):.1f} "
+            f"examples on average, label padding {label_padding_ratio(batch_sampler.batches, label_lengths):.1%} "
+            f"(random batches of {batch_size}: {label_padding_ratio(random_batches, label_lengths):.1%})"
+        )
+        worker_init_fn = seed_worker
+        if "rank" in inspect.signature(seed_worker).parameters:
+            worker_init_fn = functools.partial(
+                seed_worker, num_workers=self.args.dataloader_num_workers, rank=self.args.process_index
+            )
+        dataloader = torch.utils.data.DataLoader(
+            self.train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            persistent_workers=self.args.dataloader_persistent_workers,
+            prefetch_factor=self.args.dataloader_prefetch_factor,
+            worker_init_fn=worker_init_fn,
+        )
+        dataloader = self.accelerator.prepare(dataloader)
+        # In distributed runs accelerate wraps the batch sampler in a `BatchSamplerShard`, which does not pass on
+        # the `set_epoch` the Trainer calls on the dataloader before every epoch, also the one it resumes in
+        shard_sampler = dataloader.batch_sampler
+        if shard_sampler is not batch_sampler and not hasattr(shard_sampler, "set_epoch"):
+            shard_sampler.set_epoch = batch_sampler.set_epoch
+        return dataloader
+
+    def _get_train_sampler(self, train_dataset=None):
+        train_dataset = train_dataset if train_dataset is not None else self.train_dataset
+        if self.args.group_by_length and isinstance(train_dataset, MultiTaskSpeechDataset):
+            return LengthGroupedSampler(
+                self.args.train_batch_size * self.args.gradient_accumulation_steps, lengths=train_dataset.lengths
+            )
+        return super()._get_train_sampler(train_dataset)
+
+    def _get_eval_sampler(self, eval_dataset):
+        if self.sort_eval_by_length and isinstance(eval_dataset, MultiTaskSpeechDataset):
+            # longest first, so that a batch that does not fit into memory fails right away
+            return np.lexsort((eval_dataset.label_lengths, eval_dataset.lengths))[::-1].tolist()
+        return super()._get_eval_sampler(eval_dataset)
+
+    def evaluate(self, eval_dataset=None, ignore_keys=None, metric_key_prefix="eval", **gen_kwargs):
+        if (
+            self.teacher_forced_metrics is not None
+            and self.is_in_train
+            and not (self.generate_eval_steps and self.state.global_step % self.generate_eval_steps == 0)
+        ):
+            return self.teacher_forced_evaluate(
+                eval_dataset, ignore_keys=ignore_keys, metric_key_prefix=metric_key_prefix
+            )
+        if self.prediction_cache_dir is None or not self.args.predict_with_generate:
+            return super().evaluate(
+                eval_dataset, ignore_keys=ignore_keys, metric_key_prefix=metric_key_prefix, **gen_kwargs
+            )
+        # the generation settings as resolved by `Seq2SeqTrainer.evaluate`
+        settings = dict(gen_kwargs)
+        if settings.get("max_length") is None and settings.get("max_new_tokens") is None:
+            settings["max_length"] = self.args.generation_max_length
+        if settings.get("num_beams") is None:
+            settings["num_beams"] = self.args.generation_num_beams
+        signature = Hasher.hash(
+            (
+                checkpoint_digest(self.model),
+                sorted(settings.items()),
+                self.max_new_tokens_per_second,
+                self.model.generation_config.to_json_string(),
+            )
+        )
+        self._prediction_cache = PredictionCache(
+            self.prediction_cache_dir, signature, process_index=self.args.process_index
+        )
+        try:
+            metrics = super().evaluate(
+                eval_dataset, ignore_keys=ignore_keys, metric_key_prefix=metric_key_prefix, **gen_kwargs
+            )
+        finally:
+            cache, self._prediction_cache = self._prediction_cache, None
+            cache.close()
+        logger.info(f"Prediction cache {cache.path}: reused {cache.hits} predictions, generated {cache.misses}")
+        return metrics
+
+    def evaluation_loop(self, *args, metric_key_prefix="eval", **kwargs):
+        if self.assisted_stats is None:
+            return super().evaluation_loop(*args, metric_key_prefix=metric_key_prefix, **kwargs)
+        self.assisted_stats.reset()
+        output = super().evaluation_loop(*args, metric_key_prefix=metric_key_prefix, **kwargs)
+        if self.assisted_stats.model_passes:
+            for name, value in self.assisted_stats.metrics().items():
+                output.metrics[f"{metric_key_prefix}_{name}"] = value
+        return output
+
+    def teacher_forced_evaluate(self, eval_dataset=None, ignore_keys=None, metric_key_prefix="eval"):
+        saved = (self.args.predict_with_generate, self.compute_metrics, self.preprocess_logits_for_metrics)
+        self.args.predict_with_generate = False
+        self.compute_metrics = self.teacher_forced_metrics
+        self.preprocess_logits_for_metrics = self.teacher_forced_preprocess_logits
+        try:
+            return super().evaluate(eval_dataset, ignore_keys=ignore_keys, metric_key_prefix=metric_key_prefix)
+        finally:
+            self.args.predict_with_generate, self.compute_metrics, self.preprocess_logits_for_metrics = saved
+
+    def prediction_step(self, model, inputs, prediction_loss_only, ignore_keys=None, **gen_kwargs):
+        inputs = dict(inputs)
+        input_length = inputs.pop("input_length", None)
+        if not self.args.predict_with_generate or prediction_loss_only:
+            return super().prediction_step(
+                model, inputs, prediction_loss_only=prediction_loss_only, ignore_keys=ignore_keys
+            )
+
+        if len(gen_kwargs) == 0 and hasattr(self, "_gen_kwargs"):
+            gen_kwargs = self._gen_kwargs.copy()
+        if "input_features" in inputs:
+            gen_kwargs["num_segment_frames"] = inputs["input_features"].shape[-1]
+        if self.max_new_tokens_per_second is not None and input_length is not None:
+            seconds = input_length.max().item() / self.processing_class.sampling_rate
+            limit = gen_kwargs.pop("max_length", None) or self.model.generation_config.max_length
+            if gen_kwargs.get("max_new_tokens") is not None:
+                limit = min(limit, gen_kwargs["max_new_tokens"])
+            # one more token for the end of text
+            gen_kwargs["max_new_tokens"] = min(int(np.ceil(seconds * self.max_new_tokens_per_second)) + 1, limit)
+
+        cache = self._prediction_cache
+        if cache is None or "labels" not in inputs:
+            return self.generation_step(model, inputs, prediction_loss_only, ignore_keys, gen_kwargs)
+
+        # the cap of a batch depends on its longest clip, so the rows are only reused under the same cap
+        keys = cache.row_keys(inputs["input_features"], inputs["labels"], gen_kwargs.get("max_new_tokens"))
+        cached = cache.get(keys)
+        if cached is None:
+            loss, generated_tokens, labels = self.generation_step(
+                model, inputs, prediction_loss_only, ignore_keys, gen_kwargs
+            )
+            tokens = []
+            for row in generated_tokens.tolist():
+                # the padding is added again when the batch is read from the cache
+                while row and row[-1] == self.model.config.pad_token_id:
+                    row.pop()
+                tokens.append(row)
+            cache.add(keys, tokens)
+            return loss, generated_tokens, labels
+
+        # only the loss is computed, against the labels
+        inputs = self._prepare_inputs(inputs)
+        with torch.no_grad(), self.compute_loss_context_manager():
+            loss = self.compute_loss(model, inputs).detach().mean()
+        if self.args.prediction_loss_only:
+            return loss, None, None
+        generated_tokens = torch.full(
+            (len(cached), max(len(row) for row in cached)),
+            self.model.config.pad_token_id,
+            dtype=torch.long,
+            device=inputs["labels"].device,
+        )
+        for row, tokens in zip(generated_tokens, cached):
+            row[: len(tokens)] = torch.tensor(tokens)
+        return loss, generated_tokens, inputs["labels"]
+
+    def generation_step(self, model, inputs, prediction_loss_only, ignore_keys, gen_kwargs):
+        """`Seq2SeqTrainer.prediction_step`, or assisted generation with `assistant_model`."""
+        if self.assistant_model is None:
+            return super().prediction_step(
+                model, inputs, prediction_loss_only=prediction_loss_only, ignore_keys=ignore_keys, **gen_kwargs
+            )
+        inputs = self._prepare_inputs(inputs)
+        loss = None
+        if "labels" in inputs:
+            with torch.no_grad(), self.compute_loss_context_manager():
+                loss = self.compute_loss(model, inputs).detach().mean()
+        # unset settings fall back to the generation config, as in `Seq2SeqTrainer.prediction_step`
+        gen_kwargs = {name: value for name, value in gen_kwargs.items() if value is not None}
+        generation_inputs = {name: inputs[name] for name in ("input_features", "attention_mask") if name in inputs}
+        rows = []
+        # assisted generation takes batches of one
+        with torch.no_grad(), self.assisted_stats.count_passes(self.model, self.assistant_model):
+            for i in range(len(generation_inputs["input_features"])):
+                row_inputs = {name: value[i : i + 1] for name, value in generation_inputs.items()}
+                rows.append(self.model.generate(**row_inputs, assistant_model=self.assistant_model, **gen_kwargs)[0])
+        self.assisted_stats.add([row.tolist() for row in rows], self.model.generation_config.eos_token_id)
+        generated_tokens = torch.nn.utils.rnn.pad_sequence(
+            rows, batch_first=True, padding_value=self.model.config.pad_token_id
+        )
+        return loss, generated_tokens, inputs.get("labels")
+
+    def compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
+        if "input_length" in inputs:
+            inputs = {name: value for name, value in inputs.items() if name != "input_length"}
+        if "teacher_top_k_ids" in inputs:
+            inputs = dict(inputs)
+            teacher_ids = inputs.pop("teacher_top_k_ids")
+            teacher_logits = inputs.pop("teacher_top_k_logits")
+            outputs = model(**inputs)
+            kl = distillation_kl(
+                outputs.logits, inputs["labels"], teacher_ids, teacher_logits, self.distillation_temperature
+            )
+            loss = (1 - self.distillation_kl_weight) * outputs.loss + self.distillation_kl_weight * kl
+            return (loss, outputs) if return_outputs else loss
+        if "labels_translate" not in inputs:
+            return super().compute_loss(
+                model, inputs, return_outputs=return_outputs, num_items_in_batch=num_items_in_batch
+            )
+        inputs = dict(inputs)
+        labels_translate = inputs.pop("labels_translate")
+        # the first pass runs the encoder (with SpecAugment, if enabled) and the transcription decoder, the second
+        # one only the translation decoder on the same encoder states
+        transcribe_outputs = model(**inputs)
+        translate_outputs = model(
+            encoder_outputs=(transcribe_outputs.encoder_last_hidden_state,), labels=labels_translate
+        )
+        # weight the task losses by their number of target tokens, which gives the loss of a batch holding both
+        # label sequences as separate examples
+        num_transcribe = inputs["labels"].ne(-100).sum()
+        num_translate = labels_translate.ne(-100).sum()
+        loss = (transcribe_outputs.loss * num_transcribe + translate_outputs.loss * num_translate) / (
+            num_transcribe + num_translate
+        )
+        return (loss, transcribe_outputs) if return_outputs else loss
+
+
+def arrow_row_to_numpy(column):
+    """NumPy view of the value of a one-row Arrow column of (nested) lists of numbers, without copying it."""
+    values = column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+    sizes = []
+    while pa.types.is_list(values.type) or pa.types.is_large_list(values.type):
+        values = values.flatten()
+        sizes.append(len(values))
+    # every level holds the number of values of all the levels above it
+    shape = [size // outer for size, outer in zip(sizes, [1] + sizes[:-1])]
+    return values.to_numpy(zero_copy_only=True).reshape(shape)
+
+
+class MultiTaskSpeechDataset(torch.utils.data.Dataset):
+    """
+    Expands every utterance into training examples that share its input features without copying them.
+    Args:
+        features ([`datasets.Dataset`])
+            One row per utterance holding the model inputs (`input_features` and optionally `attention_mask`).
+        index ([`datasets.Dataset`])
+            One row per example with an `utterance_idx` column pointing into `features`. Its other columns (e.g.
+            `labels` and `input_length`, see `build_task_index` and `build_utterance_index`) are added to the
+            example.
+        numpy_views (`bool`, *optional*, defaults to `False`)
+            Whether to return the (nested) list columns of `features` as read-only NumPy views of the Arrow cache,
+            in their storage dtype, instead of decoding them to Python lists. Only for numeric columns, e.g. cached
+            input features, see [`DataCollatorSpeechSeq2SeqWithStacking`].
+    """
+
+    def __init__(self, features, index, numpy_views=False):
+        self.features = features
+        self.index = index
+        self.numpy_views = numpy_views
+        self._arrow_features = features.with_format("arrow") if numpy_views else None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        row = self.index[int(idx)]
+        example = self.get_features(row.pop("utterance_idx"))
+        example.update(row)
+        return example
+
+    def get_features(self, utterance_idx):
+        if not self.numpy_views:
+            return dict(self.features[utterance_idx])
+        table = self._arrow_features[utterance_idx]
+        return {name: arrow_row_to_numpy(table.column(name)) for name in table.column_names}
+
+    @property
+    def lengths(self):
+        return self.index["input_length"]
+
+    @property
+    def label_lengths(self):
+        # examples of the shared encoder mode carry one label sequence per task
+        label_columns = [name for name in self.index.column_names if name.startswith("labels")]
+        return np.max([[len(labels) for labels in self.index[name]] for name in label_columns], axis=0).tolist()
+
+    @property
+    def cache_files(self):
+        return self.features.cache_files + self.index.cache_files
+
+
+def build_task_index(batch, indices):
+    """Builds the (utterance_idx, task, labels) rows for a batch of preprocessed utterances."""
+    batch_size = len(indices)
+    return {
+        "utterance_idx": list(indices) * 2,
+        "task": ["transcribe"] * batch_size + ["translate"] * batch_size,
+        "labels": batch["labels_transcribe"] + batch["labels_translate"],
+        "input_length": batch["input_length"] * 2,
+    }
+
+
+def build_utterance_index(batch, indices):
+    """Builds the (utterance_idx, labels_transcribe, labels_translate) rows for a batch of preprocessed utterances."""
+    return {"utterance_idx": list(indices), **batch}
+
+
+class PackedSpeechDataset(MultiTaskSpeechDataset):
+    """
+    Training examples of several utterances packed into one encoder window (`--pack_utterances`).
+    Args:
+        features ([`datasets.Dataset`])
+            One row per utterance holding the model inputs, padded to the full window.
+        index ([`datasets.Dataset`])
+            One row per packed example, see `pack_task_index`.
+        gap_frames (`int`)
+            Number of silent mel frames between two utterances.
+    """
+
+    def __init__(self, features, index, gap_frames, numpy_views=False):
+        super().__init__(features, index, numpy_views=numpy_views)
+        self.gap_frames = gap_frames
+
+    def __getitem__(self, idx):
+        row = self.index[int(idx)]
+        segments = []
+        for utterance_idx, num_frames in zip(row.pop("utterance_idx"), row.pop("num_frames")):
+            utterance = self.get_features(utterance_idx)
+            input_features = decompress_input_features(
+                utterance["input_features"], utterance.get("input_features_scale")
+            )
+            # the padding columns of an utterance hold its own level of silence
+            silence = input_features[:, -1:]
+            segments += [input_features[:, :num_frames], np.repeat(silence, self.gap_frames, axis=1)]
+        window = input_features.shape[-1]
+        input_features = np.concatenate(segments[:-1], axis=1)[:, :window]
+        used_frames = input_features.shape[-1]
+        input_features = np.concatenate([input_features, np.repeat(silence, window - used_frames, axis=1)], axis=1)
+        example = {"input_features": input_features, **row}
+        if "attention_mask" in utterance:
+            example["attention_mask"] = np.arange(window) < used_frames
+        return example
+
+
+def pack_task_index(index, max_frames, max_label_length, hop_length, gap_frames, prefix_length, tokenizer, seed):
+    """
+    Greedily packs the (utterance, task) rows of `index` (see `build_task_index`) into examples of utterances with
+    the same label prefix, i.e. the same language and task, that fit into `max_frames` mel frames with `gap_frames`
+    between them and into `max_label_length` target tokens. The label bodies are joined under a single prefix, every
+    one after the first re-encoded by `tokenizer` with a leading space, as the text of the whole window would be
+    tokenized. Returns the packed index with the columns `utterance_idx`, `num_frames`, `labels` and `input_length`
+    for [`PackedSpeechDataset`].
+    """
+    groups = defaultdict(list)
+    for row_idx, labels in enumerate(index["labels"]):
+        groups[tuple(labels[:prefix_length])].append(row_idx)
+    utterance_idx = index["utterance_idx"]
+    input_length = index["input_length"]
+    labels = index["labels"]
+    # the label bodies as they are tokenized after the end of the previous utterance
+    texts = tokenizer.batch_decode([row[prefix_length:-1] for row in labels], clean_up_tokenization_spaces=False)
+    continued_bodies = tokenizer([" " + text for text in texts], add_special_tokens=False).input_ids
+
+    rng = np.random.default_rng(seed)
+    packed = {"utterance_idx": [], "num_frames": [], "labels": [], "input_length": []}
+
+    def add_pack(prefix, rows, frames, bodies):
+        packed["utterance_idx"].append([utterance_idx[row] for row in rows])
+        packed["num_frames"].append(frames)
+        packed["labels"].append(list(prefix) + bodies + [labels[rows[0]][-1]])
+        packed["input_length"].append((sum(frames) + gap_frames * (len(frames) - 1)) * hop_length)
+
+    for prefix in sorted(groups):
+        rows, frames, bodies = [], [], []
+        for row in rng.permutation(groups[prefix]):
+            num_frames = min(-(-input_length[row] // hop_length), max_frames)
+            if rows and (
+                sum(frames) + gap_frames * len(frames) + num_frames > max_frames
+                or prefix_length + len(bodies) + len(continued_bodies[row]) + 1 > max_label_length
+            ):
+                add_pack(prefix, rows, frames, bodies)
+                rows, frames, bodies = [], [], []
+            rows.append(int(row))
+            frames.append(num_frames)
+            bodies += continued_bodies[row] if len(rows) > 1 else labels[row][prefix_length:-1]
+        add_pack(prefix, rows, frames, bodies)
+
+    audio_frames = sum(sum(frames) for frames in packed["num_frames"])
+    logger.info(
+        f"Packed {len(labels)} training examples into {len(packed['labels'])} windows: audio fills "
+        f"{audio_frames / (len(packed['labels']) * max_frames):.1%} of the encoder input, "
+        f"{audio_frames / (len(labels) * max_frames):.1%} without packing"
+    )
+    return datasets.Dataset.from_dict(packed)
+
+
+def text_metric_counts(predictions, references, task):
+    """
+    Sufficient statistics of one group of normalised predictions and references: summed word and character edit
+    distances and reference lengths for "transcribe", per-sentence BLEU and chrF statistics for "translate".
+    """
+    if task == "transcribe":
+        counts = {"word_errors": 0, "words": 0, "char_errors": 0, "chars": 0}
+        for prediction, reference in zip(predictions, references):
+            reference_words = reference.split()
+            counts["word_errors"] += Levenshtein.distance(reference_words, prediction.split())
+            counts["words"] += len(reference_words)
+            counts["char_errors"] += Levenshtein.distance(reference.strip(), prediction.strip())
+            counts["chars"] += len(reference.strip())
+        return counts
+    return {
+        "bleu": BLEU_METRIC._extract_corpus_statistics(predictions, [references]),
+        "chrf": CHRF_METRIC._extract_corpus_statistics(predictions, [references]),
+    }
+
+
+def text_metric_scores(counts, task):
+    """WER/CER or BLEU/chrF from the (summed) statistics of `text_metric_counts`."""
+    if task == "transcribe":
+        return {
+            "wer": counts["word_errors"] / max(counts["words"], 1),
+            "cer": counts["char_errors"] / max(counts["chars"], 1),
+        }
+    return {
+        "bleu": BLEU_METRIC._aggregate_and_compute(counts["bleu"]).score,
+        "chrf": CHRF_METRIC._aggregate_and_compute(counts["chrf"]).score,
+    }
+
+
+def group_rows(group_keys, group_names):
+    """
+    Splits the rows of `group_keys`, an array with one (language token, task token) row per example, by their
+    token pair in one pass. Yields the (language name, task) of every pair in `group_names` with the indices of its
+    rows; rows with another pair are skipped.
+    """
+    keys, inverse = np.unique(np.asarray(group_keys), axis=0, return_inverse=True)
+    order = np.argsort(inverse.reshape(-1), kind="stable")
+    boundaries = np.cumsum(np.bincount(inverse.reshape(-1), minlength=len(keys)))[:-1]
+    for key, rows in zip(keys, np.split(order, boundaries)):
+        if tuple(key.tolist()) in group_names:
+            yield group_names[tuple(key.tolist())], rows
+
+
+def compute_grouped_metrics(predictions, references, group_keys, group_names):
+    """
+    Scores decoded `predictions` against `references` per language and task, grouped by `group_rows`. The
+    statistics of every group are computed once. Returns `{lang_name}_wer`/`_cer` for transcription and
+    `{lang_name}_bleu`/`_chrf` for translation, plus `avg_transcribe_*` and `avg_translate_*` corpus scores over all
+    languages computed from the summed statistics.
+    """
+    metrics = {}
+    totals = {}
+    for (lang_name, task), rows in group_rows(group_keys, group_names):
+        counts = text_metric_counts([predictions[i] for i in rows], [references[i] for i in rows], task)
+        for name, score in text_metric_scores(counts, task).items():
+            metrics[f"{lang_name}_{name}"] = score
+        if task in totals:
+            totals[task] = {name: totals[task][name] + value for name, value in counts.items()}
+        else:
+            totals[task] = counts
+    for task, counts in totals.items():
+        for name, score in text_metric_scores(counts, task).items():
+            metrics[f"avg_{task}_{name}"] = score
+    return metrics
+
+
+def compute_teacher_forced_metrics(pred_ids, token_losses, label_ids, group_names, tokenizer, prefix_length):
+    """
+    Scores one teacher-forced forward pass over the labels per language and task (`--teacher_forced_eval`).
+    `pred_ids` and `token_losses` hold the most likely token and the loss at every label position, `label_ids` the
+    labels without their start token, padded with -100. The first `prefix_length` label tokens are the language,
+    task and timestamp tokens. Returns the mean token loss (`{lang_name}_{task}_loss`), the share of correctly
+    predicted target tokens after the prefix (`_accuracy`) and the CER of the decoded predicted tokens against the
+    target (`_cer`) of every language and task, plus `avg_{task}_*` over all languages.
+    """
+    label_mask = label_ids != -100
+    target_mask = label_mask.copy()
+    target_mask[:, :prefix_length] = False
+    # the losses of the padding positions are -100, like the labels
+    token_losses = np.where(label_mask, token_losses, 0.0)
+
+    metrics = {}
+    totals = {}
+    for (lang_name, task), rows in group_rows(label_ids[:, :2], group_names):
+        predictions = tokenizer.batch_decode(
+            [pred_ids[i][target_mask[i]] for i in rows], skip_special_tokens=True
+        )
+        references = tokenizer.batch_decode(
+            [label_ids[i][target_mask[i]] for i in rows], skip_special_tokens=True
+        )
+        counts = text_metric_counts(preprocess_batch(predictions), preprocess_batch(references), "transcribe")
+        counts = {
+            "loss": token_losses[rows].sum(),
+            "label_tokens": label_mask[rows].sum(),
+            "correct": ((pred_ids[rows] == label_ids[rows]) & target_mask[rows]).sum(),
+            "target_tokens": target_mask[rows].sum(),
+            "char_errors": counts["char_errors"],
+            "chars": counts["chars"],
+        }
+        totals[task] = {name: totals.get(task, {}).get(name, 0) + value for name, value in counts.items()}
+        for name, score in teacher_forced_scores(counts).items():
+            metrics[f"{lang_name}_{task}_{name}"] = score
+    for task, counts in totals.items():
+        for name, score in teacher_forced_scores(counts).items():
+            metrics[f"avg_{task}_{name}"] = score
+    return metrics
+
+
+def teacher_forced_scores(counts):
+    return {
+        "loss": float(counts["loss"] / max(counts["label_tokens"], 1)),
+        "accuracy": float(counts["correct"] / max(counts["target_tokens"], 1)),
+        "cer": counts["char_errors"] / max(counts["chars"], 1),
+    }
+
+
 def main():
     # 1. Parse input arguments
     # See all possible arguments in src/transformers/training_args.py
@@ -306,6 +1625,20 @@ def main():
         transformers.utils.logging.set_verbosity_info()
     logger.info("Training/evaluation parameters %s", training_args)
 
+    if data_args.pack_utterances and (data_args.streaming_features or data_args.share_encoder_across_tasks):
+        raise ValueError(
+            "`pack_utterances` packs cached input features per task and can not be combined with "
+            "`streaming_features` or `share_encoder_across_tasks`."
+        )
+
+    if model_args.teacher_model_name_or_path is not None and (
+        data_args.pack_utterances or data_args.share_encoder_across_tasks
+    ):
+        raise ValueError(
+            "`teacher_model_name_or_path` caches teacher logits per (utterance, task) example and can not be combined "
+            "with `pack_utterances` or `share_encoder_across_tasks`."
+        )
+
     # 3. Detecting last checkpoint and eventually continue from last checkpoint
     last_checkpoint = None
     if os.path.isdir(training_args.output_dir) and training_args.do_train and not training_args.overwrite_output_dir:
@@ -328,57 +1661,50 @@ def main():
     raw_datasets = DatasetDict()
 
     # List of languages and their corresponding codes
-    languages = {
-        "hawrami": "fa",
-        "gilaki": "de", 
-        "zazaki": "es",
-        "mazanderani": "it",
-        "laki_kurdish": "fr",
-        "southern_kurdish": "nl",
-        "talysh": "pt",
-    }
-
-    # Load and combine datasets for all languages
-    train_datasets = []
-    eval_datasets = []
-    
-    for lang_name, lang_code in languages.items():
-        # Load train split
-        train_dataset = load_dataset("razhan/DOLMA-speech", lang_name, split="train")
-        # Remove id column and add it back with consistent type
-        columns_to_remove = ["id"]
-        train_dataset = train_dataset.remove_columns(columns_to_remove)
-        # Add row indices as new id column
-        train_dataset = train_dataset.add_column("id", list(range(len(train_dataset))))
-        # Update language code
-        train_dataset = train_dataset.map(lambda x: {"language": lang_code})
-        
-        # Apply max_train_samples if specified
-        if data_args.max_train_samples is not None:
-            train_dataset = train_dataset.select(range(min(len(train_dataset), data_args.max_train_samples)))
-        
-        train_datasets.append(train_dataset)
-
-        if training_args.do_eval:
-            # Load test split
-            eval_dataset = load_dataset("razhan/DOLMA-speech", lang_name, split="test")
-            # Remove id column and add it back with consistent type
-            eval_dataset = eval_dataset.remove_columns(columns_to_remove)
-            # Add row indices as new id column
-            eval_dataset = eval_dataset.add_column("id", list(range(len(eval_dataset))))
-            # Update language code
-            eval_dataset = eval_dataset.map(lambda x: {"language": lang_code})
-            
-            # Apply max_eval_samples if specified
-            if data_args.max_eval_samples is not None:
-                eval_dataset = eval_dataset.select(range(min(len(eval_dataset), data_args.max_eval_samples)))
-            
-            eval_datasets.append(eval_dataset)
+    languages = LANGUAGES
+    if data_args.language_names is not None:
+        unknown = sorted(set(data_args.language_names) - set(LANGUAGES))
+        if unknown:
+            raise ValueError(f"Unknown `language_names` {unknown}; choose from {sorted(LANGUAGES)}")
+        languages = {lang_name: LANGUAGES[lang_name] for lang_name in data_args.language_names}
+
+    # Load the configs of all languages concurrently; every step below has a deterministic fingerprint, so a
+    # second run with the same arguments reuses the datasets cache
+    splits = {"train": (data_args.train_split_name, data_args.max_train_samples)}
+    if training_args.do_eval:
+        splits["eval"] = (data_args.eval_split_name, data_args.max_eval_samples)
+    jobs = [(split, lang_name) for split in splits for lang_name in languages]
+    # tqdm's `thread_map`, used inside `datasets` and `huggingface_hub`, deletes the class-wide tqdm lock on exit
+    # unless one existed before, which breaks progress bars still running in the other loader threads
+    tqdm.get_lock()
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        futures = [
+            executor.submit(
+                load_language_split,
+                data_args.dataset_name or "razhan/DOLMA-speech",
+                lang_name,
+                languages[lang_name],
+                splits[split][0],
+                data_args.min_duration_in_seconds,
+                data_args.max_duration_in_seconds,
+                splits[split][1],
+                model_args.cache_dir,
+                data_args.dataset_revision,
+            )
+            for split, lang_name in jobs
+        ]
+        loaded = [future.result() for future in futures]
 
     # Combine all language datasets
-    raw_datasets["train"] = datasets.concatenate_datasets(train_datasets)
-    if training_args.do_eval:
-        raw_datasets["eval"] = datasets.concatenate_datasets(eval_datasets)
+    for split in splits:
+        split_datasets = []
+        for (job_split, lang_name), (dataset, skipped_rows, skipped_seconds) in zip(jobs, loaded):
+            if job_split == split:
+                logger.info(
+                    f"{lang_name} {split}: skipped {skipped_rows} rows ({skipped_seconds:.1f}s of audio) by duration"
+                )
+                split_datasets.append(dataset)
+        raw_datasets[split] = datasets.concatenate_datasets(split_datasets)
 
     # Distributed training:
     # The .from_pretrained methods guarantee that only one local process can concurrently
@@ -428,6 +1754,9 @@ def main():
         model.freeze_encoder()
         model.model.encoder.gradient_checkpointing = False
 
+    if model_args.student_decoder_layers is not None:
+        keep_decoder_layers(model, model_args.student_decoder_layers)
+
     if hasattr(model.generation_config, "is_multilingual") and model.generation_config.is_multilingual:
         # We only need to set the language and task ids in a multilingual setting
         tokenizer.set_prefix_tokens(language=data_args.language, task=data_args.task)
@@ -457,18 +1786,69 @@ def main():
         )
         model.generation_config.suppress_tokens = model_args.suppress_tokens
 
+    assistant_model = None
+    if model_args.assistant_model_name_or_path is not None:
+        if training_args.generation_num_beams not in (None, 1):
+            raise ValueError("`assistant_model_name_or_path` needs greedy generation (`generation_num_beams` 1).")
+        assistant_model = AutoModelForSpeechSeq2Seq.from_pretrained(
+            model_args.assistant_model_name_or_path,
+            cache_dir=model_args.cache_dir,
+            token=model_args.token,
+            trust_remote_code=model_args.trust_remote_code,
+        )
+        if assistant_model.config.vocab_size != model.config.vocab_size:
+            raise ValueError(
+                f"The draft model {model_args.assistant_model_name_or_path} has a vocabulary of "
+                f"{assistant_model.config.vocab_size} tokens, the model {model.config.vocab_size}."
+            )
+        # the draft model continues the decoder prompt of the model
+        assistant_model.generation_config.language = model.generation_config.language
+        assistant_model.generation_config.task = model.generation_config.task
+        assistant_model.generation_config.forced_decoder_ids = None
+        assistant_model.config.forced_decoder_ids = None
+
     # 6. Resample speech dataset if necessary
-    
-    raw_datasets = raw_datasets.cast_column(
-        data_args.audio_column_name, datasets.features.Audio(sampling_rate=feature_extractor.sampling_rate)
-    )
+    audio_column_name = data_args.audio_column_name
+    if data_args.pcm_cache_dir is not None:
+        # Decode and resample every clip once into the PCM cache. The audio column is replaced by the cache key of
+        # each clip, so preprocessing and the data collator read memory-mapped PCM instead of decoding mp3s.
+        raw_datasets = raw_datasets.cast_column(audio_column_name, datasets.features.Audio(decode=False))
+        with training_args.main_process_first(desc="pcm cache"):
+            # Only the main process adds clips. The other processes get here once it is done and open the finished
+            # index read-only, so no two processes ever append to the same shard.
+            pcm_cache = PCMCache(
+                data_args.pcm_cache_dir,
+                sampling_rate=feature_extractor.sampling_rate,
+                read_only=not is_main_process(training_args.local_rank),
+            )
+            for split, dataset in raw_datasets.items():
+                dataset = dataset.map(
+                    lambda batch: {"pcm_key": [audio_key(audio) for audio in batch[audio_column_name]]},
+                    batched=True,
+                    batch_size=data_args.preprocessing_batch_size,
+                    load_from_cache_file=not data_args.overwrite_cache,
+                    new_fingerprint=Hasher.hash((dataset._fingerprint, inspect.getsource(audio_key))),
+                    desc=f"hash {split} audio",
+                )
+                missing = [i for i, key in enumerate(dataset["pcm_key"]) if key not in pcm_cache]
+                if missing:
+                    undecoded = dataset.select(missing).select_columns([audio_column_name])
+                    added = pcm_cache.add(
+                        (row[audio_column_name] for row in undecoded), num_workers=data_args.preprocessing_num_workers
+                    )
+                    logger.info(f"Decoded {added} new {split} clips into the PCM cache at {data_args.pcm_cache_dir}")
+                raw_datasets[split] = dataset.remove_columns(audio_column_name)
+        audio_column_name = "pcm_key"
+    else:
+        pcm_cache = None
+        raw_datasets = raw_datasets.cast_column(
+            audio_column_name, datasets.features.Audio(sampling_rate=feature_extractor.sampling_rate)
+        )
 
     # 7. Preprocessing the datasets.
     # We need to read the audio files as arrays and tokenize the targets.
     max_input_length = data_args.max_duration_in_seconds * feature_extractor.sampling_rate
     min_input_length = data_args.min_duration_in_seconds * feature_extractor.sampling_rate
-    audio_column_name = data_args.audio_column_name
-    num_workers = data_args.preprocessing_num_workers
     transcription_column_name = data_args.transcription_column_name
     model_input_name = feature_extractor.model_input_names[0]
     do_lower_case = data_args.do_lower_case
@@ -479,35 +1859,73 @@ def main():
         and getattr(config, "mask_time_prob", 0) > 0
     )
 
-    def prepare_dataset_translation(batch):
-        """Process dataset for both transcription and translation"""
-        # process audio
-        sample = batch[audio_column_name]
+    frame_buckets = None
+    if data_args.encoder_length_buckets is not None:
+        frame_buckets = {
+            int(float(seconds) * feature_extractor.sampling_rate / feature_extractor.hop_length) // 2 * 2
+            for seconds in data_args.encoder_length_buckets.split(",")
+        }
+        frame_buckets = sorted(frame_buckets | {feature_extractor.nb_max_frames})
+        if frame_buckets[-1] > feature_extractor.nb_max_frames:
+            raise ValueError(
+                f"`encoder_length_buckets` can not exceed {feature_extractor.chunk_length} seconds, "
+                f"got {data_args.encoder_length_buckets}."
+            )
+        enable_encoder_length_buckets(model)
+        if assistant_model is not None:
+            enable_encoder_length_buckets(assistant_model)
+        training_args.group_by_length = True
+
+    # Label prefixes for every language/task pair are looked up once, so that tokenizing a batch never has to
+    # mutate the shared tokenizer.
+    prefix_ids = build_prefix_table(tokenizer, languages.values())
+
+    def prepare_features(batch):
+        """Turn a batch of decoded audio into log-mel input features"""
+        # process audio: the whole batch is padded to 30s and turned into log-mels with one stacked STFT
+        if pcm_cache is not None:
+            arrays = [pcm_cache.load(key) for key in batch[audio_column_name]]
+        else:
+            arrays = [sample["array"] for sample in batch[audio_column_name]]
         inputs = feature_extractor(
-            sample["array"], sampling_rate=sample["sampling_rate"], return_attention_mask=forward_attention_mask
+            arrays, sampling_rate=feature_extractor.sampling_rate, return_attention_mask=forward_attention_mask
         )
-        
+
         # process audio length
-        batch["input_features"] = inputs.get("input_features")[0]
-        batch["input_length"] = len(sample["array"])
+        batch["input_features"], scales = compress_input_features(
+            inputs.get("input_features"), data_args.feature_storage_dtype
+        )
+        if scales is not None:
+            batch["input_features_scale"] = scales
+        batch["input_length"] = [len(array) for array in arrays]
         if forward_attention_mask:
-            batch["attention_mask"] = inputs.get("attention_mask")[0]
-
-        # process targets for translation with language-specific prefix
-        tokenizer.set_prefix_tokens(language=batch["language"], task="translate")
-        input_str_translate = batch["english"].lower() 
-        batch["labels_translate"] = tokenizer(input_str_translate).input_ids
-        
-        # process targets for transcription with language-specific prefix
-        tokenizer.set_prefix_tokens(language=batch["language"], task="transcribe")
-        input_str_transcribe = preprocess_func(batch[transcription_column_name])
-        batch["labels_transcribe"] = tokenizer(input_str_transcribe).input_ids
-
+            batch["attention_mask"] = inputs.get("attention_mask")
+        return batch
 
+    def prepare_labels(batch):
+        """Tokenize a batch of targets for both transcription and translation"""
+        # tokenize all bodies of each task in one call and prepend the language-specific prefix
+        translate_bodies = tokenizer(
+            [text.lower() for text in batch["english"]], add_special_tokens=False
+        ).input_ids
+        transcribe_bodies = tokenizer(
+            preprocess_batch(batch[transcription_column_name]), add_special_tokens=False
+        ).input_ids
+        batch["labels_translate"] = [
+            prefix_ids[(lang_code, "translate")] + body + [tokenizer.eos_token_id]
+            for lang_code, body in zip(batch["language"], translate_bodies)
+        ]
+        batch["labels_transcribe"] = [
+            prefix_ids[(lang_code, "transcribe")] + body + [tokenizer.eos_token_id]
+            for lang_code, body in zip(batch["language"], transcribe_bodies)
+        ]
         return batch
-    
 
-    
+    def prepare_streaming_labels(batch):
+        """Tokenize the targets of a batch and take its input length from the `duration` column"""
+        batch["input_length"] = [int(duration * feature_extractor.sampling_rate) for duration in batch["duration"]]
+        return prepare_labels(batch)
+
     # def prepare_dataset(batch):
     #     # process audio
     #     sample = batch[audio_column_name]
@@ -527,92 +1945,157 @@ def main():
     #     batch["labels"] = tokenizer(input_str).input_ids
     #     return batch
 
-    def flatten_dataset(batch):
-        """Flatten the dataset to combine transcription and translation samples efficiently"""
-        batch_size = len(batch["input_features"])
-        
-        # Create lists for both transcription and translation samples
-        combined_features = []
-        combined_masks = []
-        combined_labels = []
-        combined_tasks = []
-        combined_lengths = []
-
-        # Pre-allocate lists with total size
-        combined_features = [None] * (batch_size * 2)
-        combined_masks = [None] * (batch_size * 2) if "attention_mask" in batch else None
-        combined_labels = [None] * (batch_size * 2)
-        combined_tasks = ["transcribe"] * batch_size + ["translate"] * batch_size
-        combined_lengths = [None] * (batch_size * 2)
-
-        # Fill lists efficiently
-        for i in range(batch_size):
-            # Transcription sample
-            combined_features[i] = batch["input_features"][i]
-            combined_labels[i] = batch["labels_transcribe"][i]
-            combined_lengths[i] = batch["input_length"][i]
-            
-            # Translation sample
-            combined_features[i + batch_size] = batch["input_features"][i]
-            combined_labels[i + batch_size] = batch["labels_translate"][i]
-            combined_lengths[i + batch_size] = batch["input_length"][i]
-            
-            # Handle attention masks if present
-            if combined_masks is not None:
-                mask = batch["attention_mask"][i]
-                combined_masks[i] = mask
-                combined_masks[i + batch_size] = mask
-
-        result = {
-            "input_features": combined_features,
-            "labels": combined_labels,
-            "task": combined_tasks,
-            "input_length": combined_lengths
-        }
-
-        if combined_masks is not None:
-            result["attention_mask"] = combined_masks
-
-        return result
+    # filter data that is shorter than min_input_length or longer than
+    # max_input_length. Most clips are already dropped on their `duration` column when loading, this catches
+    # decoded lengths that disagree with the metadata.
+    def is_audio_in_length_range(length):
+        return length > min_input_length and length < max_input_length
+
+    # The fingerprints of the preprocessing maps are derived from everything that determines their output, instead
+    # of from pickling the closures above, which is not stable across runs.
+    feature_signature = Hasher.hash(
+        (
+            feature_extractor.to_json_string(),
+            forward_attention_mask,
+            data_args.feature_storage_dtype,
+            inspect.getsource(prepare_features),
+        )
+    )
+    label_signature = Hasher.hash(
+        (
+            tokenizer.name_or_path,
+            len(tokenizer),
+            prefix_ids,
+            transcription_column_name,
+            [inspect.getsource(func) for func in (preprocess_func, preprocess_batch, prepare_labels)],
+        )
+    )
+    feature_columns = [model_input_name] + (["attention_mask"] if forward_attention_mask else [])
+    if data_args.feature_storage_dtype == "int8":
+        feature_columns.append("input_features_scale")
+    label_columns = ["labels_transcribe", "labels_translate", "input_length"]
 
     with training_args.main_process_first(desc="dataset map pre-processing"):
-        # Map and process the dataset
-        vectorized_datasets = raw_datasets.map(
-            prepare_dataset_translation,
-            remove_columns=next(iter(raw_datasets.values())).column_names,
-            num_proc=data_args.preprocessing_num_workers,
-            desc="preprocess dataset",
-        )
-        
-        # Flatten the dataset to combine transcription and translation samples
-        flattened_datasets = DatasetDict()
-        for split, dataset in vectorized_datasets.items():
-            flattened_datasets[split] = dataset.map(
-                flatten_dataset, 
-                batched=True, 
-                remove_columns=dataset.column_names,
-                desc=f"flatten {split} dataset"
+        vectorized_datasets = DatasetDict()
+        feature_datasets = DatasetDict()
+        task_indices = DatasetDict()
+        for split, dataset in raw_datasets.items():
+            text_dataset = dataset.remove_columns(audio_column_name)
+            if data_args.streaming_features:
+                # Only the audio column is kept as model input: it stays compressed on disk and is decoded,
+                # resampled and turned into log-mels by the data collator in the dataloader workers. Clips were
+                # already filtered on their `duration` column when loading, which also gives their input length.
+                vectorized_datasets[split] = text_dataset.map(
+                    prepare_streaming_labels,
+                    batched=True,
+                    batch_size=data_args.preprocessing_batch_size,
+                    remove_columns=text_dataset.column_names,
+                    num_proc=data_args.preprocessing_num_workers,
+                    load_from_cache_file=not data_args.overwrite_cache,
+                    new_fingerprint=Hasher.hash(
+                        (text_dataset._fingerprint, label_signature, inspect.getsource(prepare_streaming_labels))
+                    ),
+                    desc=f"tokenize {split} targets",
+                )
+                feature_datasets[split] = dataset.select_columns([audio_column_name])
+                continue
+
+            audio_dataset = dataset.select_columns([audio_column_name])
+
+            def compute_features(cache_file_name=None):
+                return audio_dataset.map(
+                    prepare_features,
+                    batched=True,
+                    batch_size=data_args.preprocessing_batch_size,
+                    remove_columns=[audio_column_name],
+                    num_proc=data_args.preprocessing_num_workers,
+                    load_from_cache_file=not data_args.overwrite_cache,
+                    cache_file_name=cache_file_name,
+                    new_fingerprint=Hasher.hash((audio_dataset._fingerprint, feature_signature)),
+                    desc=f"extract {split} features",
+                )
+
+            if data_args.feature_store_dir is not None:
+                # log-mels only depend on the audio and the feature extractor, so runs with other model sizes,
+                # tokenizers or hyper-parameters attach to the same stored features
+                features = load_or_build_feature_store(
+                    data_args.feature_store_dir,
+                    f"{split}-{Hasher.hash((FEATURE_STORE_VERSION, feature_signature, audio_dataset._fingerprint))}",
+                    compute_features,
+                    metadata={
+                        "version": FEATURE_STORE_VERSION,
+                        "feature_extractor": feature_extractor.to_dict(),
+                        "feature_storage_dtype": data_args.feature_storage_dtype,
+                        "return_attention_mask": forward_attention_mask,
+                        "dataset": data_args.dataset_name or "razhan/DOLMA-speech",
+                        "dataset_revision": data_args.dataset_revision,
+                        "source_fingerprint": audio_dataset._fingerprint,
+                    },
+                )
+            else:
+                features = compute_features()
+
+            labels = text_dataset.map(
+                prepare_labels,
+                batched=True,
+                batch_size=data_args.preprocessing_batch_size,
+                remove_columns=text_dataset.column_names,
+                num_proc=data_args.preprocessing_num_workers,
+                load_from_cache_file=not data_args.overwrite_cache,
+                new_fingerprint=Hasher.hash((text_dataset._fingerprint, label_signature)),
+                desc=f"tokenize {split} targets",
+            )
+            labels = labels.add_column(
+                "input_length",
+                features["input_length"],
+                new_fingerprint=Hasher.hash((labels._fingerprint, features._fingerprint)),
             )
 
-        # filter data that is shorter than min_input_length or longer than
-        # max_input_length
-        def is_audio_in_length_range(length):
-            return length > min_input_length and length < max_input_length
-
-
+            keep = np.flatnonzero([is_audio_in_length_range(length) for length in labels["input_length"]])
+            vectorized_datasets[split] = labels.select(keep)
+            feature_datasets[split] = features.select_columns(feature_columns).select(keep)
 
-        # Apply filter to flattened_datasets
-        filtered_datasets = DatasetDict()
-        for split, dataset in flattened_datasets.items():
-            filtered_datasets[split] = dataset.filter(
-                is_audio_in_length_range,
-                num_proc=num_workers,
-                input_columns=["input_length"],
+        for split, dataset in vectorized_datasets.items():
+            # Expand every utterance into a transcription and a translation sample. Only the labels are
+            # duplicated: both samples point back to the same row of input features. With a shared encoder the
+            # training samples keep both label sequences of their utterance instead.
+            labels = dataset.select_columns(label_columns)
+            build_index = (
+                build_utterance_index
+                if data_args.share_encoder_across_tasks and split == "train"
+                else build_task_index
+            )
+            task_indices[split] = labels.map(
+                build_index,
+                batched=True,
+                with_indices=True,
+                remove_columns=label_columns,
+                load_from_cache_file=not data_args.overwrite_cache,
+                new_fingerprint=Hasher.hash((labels._fingerprint, inspect.getsource(build_index))),
+                desc=f"index {split} tasks",
             )
 
-        # Update vectorized_datasets to use the filtered version
-        vectorized_datasets = filtered_datasets
-
+        vectorized_datasets = {
+            split: MultiTaskSpeechDataset(
+                feature_datasets[split], task_indices[split], numpy_views=not data_args.streaming_features
+            )
+            for split in vectorized_datasets
+        }
+        if data_args.pack_utterances and "train" in vectorized_datasets:
+            gap_frames = int(PACKING_GAP_SECONDS * feature_extractor.sampling_rate / feature_extractor.hop_length)
+            packed_index = pack_task_index(
+                task_indices["train"],
+                max_frames=feature_extractor.nb_max_frames,
+                max_label_length=model.config.max_target_positions,
+                hop_length=feature_extractor.hop_length,
+                gap_frames=gap_frames,
+                prefix_length=len(next(iter(prefix_ids.values()))),
+                tokenizer=tokenizer,
+                seed=training_args.seed,
+            )
+            vectorized_datasets["train"] = PackedSpeechDataset(
+                feature_datasets["train"], packed_index, gap_frames, numpy_views=True
+            )
 
     # for large datasets it is advised to run the preprocessing on a
     # single machine first with `args.preprocessing_only` since there will mostly likely
@@ -624,100 +2107,53 @@ def main():
         logger.info(f"Data preprocessing finished. Files cached at {cache}.")
         return
 
-    # 8. Load Metric
-    wer_metric = evaluate.load("wer", cache_dir=model_args.cache_dir)
-    cer_metric = evaluate.load("cer", cache_dir=model_args.cache_dir)
-    bleu_metric = evaluate.load("sacrebleu", cache_dir=model_args.cache_dir)
-    chrf_metric = evaluate.load("chrf", cache_dir=model_args.cache_dir)
-
-
-    # These needs to be modified if we finetune for large v3 and turbo
-    language_ids = {
-        "fa": 50300,
-        "de": 50261, 
-        "es": 50262,
-        "it": 50274,
-        "fr": 50265,
-        "nl": 50271,
-        "pt": 50267,
-    }
+    prefix_length = len(next(iter(prefix_ids.values())))
+    if data_args.eval_max_new_tokens_per_second is not None and "eval" in vectorized_datasets:
+        # every row is capped at least by its own duration, longer batch neighbours only raise the cap
+        eval_dataset = vectorized_datasets["eval"]
+        seconds = np.asarray(eval_dataset.lengths) / feature_extractor.sampling_rate
+        caps = np.ceil(seconds * data_args.eval_max_new_tokens_per_second) + 1
+        truncated = np.asarray(eval_dataset.label_lengths) - prefix_length > caps
+        logger.info(
+            f"Generation is capped at {data_args.eval_max_new_tokens_per_second} tokens per second, "
+            f"{truncated.mean():.1%} of the eval references are longer than the cap of their own clip"
+        )
 
-    task_to_id =  {
-        "transcribe": 50359,
-        "translate": 50358
+    # 8. Load Metric
+    # The language and task tokens of the label prefixes, from the tokenizer of the checkpoint being trained
+    code_to_name = {code: name for name, code in languages.items()}
+    group_names = {
+        (prefix[1], prefix[2]): (code_to_name[lang_code], task) for (lang_code, task), prefix in prefix_ids.items()
     }
 
-
-    
     def compute_metrics(pred):
         pred_ids = pred.predictions
-        
+        label_ids = pred.label_ids
+
         # Replace padding tokens with pad_token_id
-        pred.label_ids[pred.label_ids == -100] = tokenizer.pad_token_id
-        
-        # Get language IDs and task IDs from the first and second tokens of each sequence
-        sequence_lang_ids = pred.label_ids[:, 0]  # First token of each sequence
-        sequence_task_ids = pred.label_ids[:, 1]  # Second token of each sequence (task)
-        
-        # Create reverse mappings for language codes and tasks
-        lang_id_to_code = {token_id: code for code, token_id in language_ids.items()}
-        code_to_name = {code: name for name, code in languages.items()}
-        task_id_to_name = {v: k for k, v in task_to_id.items()}
-        
+        pred_ids[pred_ids == -100] = tokenizer.pad_token_id
+        label_ids[label_ids == -100] = tokenizer.pad_token_id
+
         # Decode predictions and labels
-        pred_str = tokenizer.batch_decode(pred_ids, skip_special_tokens=True)
-        pred_str = [preprocess_func(s) for s in pred_str]
-        label_str = tokenizer.batch_decode(pred.label_ids, skip_special_tokens=True)
-        label_str = [preprocess_func(s) for s in label_str]
-        
-        # Calculate metrics per language and task
-        metrics = {}
-        for lang_token_id in set(sequence_lang_ids):
-            if lang_token_id in lang_id_to_code:
-                lang_code = lang_id_to_code[lang_token_id]
-                lang_name = code_to_name[lang_code]
-                
-                for task_token_id in set(sequence_task_ids):
-                    if task_token_id in task_id_to_name:
-                        task_name = task_id_to_name[task_token_id]
-                        
-                        # Create mask for this language and task combination
-                        mask = (sequence_lang_ids == lang_token_id) & (sequence_task_ids == task_token_id)
-                        
-                        # Get predictions and references for this language and task
-                        task_preds = [pred_str[i] for i, m in enumerate(mask) if m]
-                        task_refs = [label_str[i] for i, m in enumerate(mask) if m]
-                        
-                        if task_preds:  # Only compute if we have predictions
-                            if task_name == "transcribe":
-                                # For transcription, compute WER and CER
-                                wer = wer_metric.compute(predictions=task_preds, references=task_refs)
-                                cer = cer_metric.compute(predictions=task_preds, references=task_refs)
-                                metrics[f"{lang_name}_wer"] = wer
-                                metrics[f"{lang_name}_cer"] = cer
-                            else:  # task_name == "translate"
-                                # For translation, compute BLEU and chrF scores
-                                bleu = bleu_metric.compute(predictions=task_preds, references=[[r] for r in task_refs])
-                                chrf = chrf_metric.compute(predictions=task_preds, references=task_refs)
-                                metrics[f"{lang_name}_bleu"] = bleu["score"]
-                                metrics[f"{lang_name}_chrf"] = chrf["score"]
-        
-        # Calculate average metrics per task
-        transcribe_wer = [v for k, v in metrics.items() if "transcribe_wer" in k]
-        transcribe_cer = [v for k, v in metrics.items() if "transcribe_cer" in k]
-        translate_bleu = [v for k, v in metrics.items() if "translate_bleu" in k]
-        translate_chrf = [v for k, v in metrics.items() if "translate_chrf" in k]
-        
-        if transcribe_wer:
-            metrics["avg_transcribe_wer"] = np.mean(transcribe_wer)
-        if transcribe_cer:
-            metrics["avg_transcribe_cer"] = np.mean(transcribe_cer)
-        if translate_bleu:
-            metrics["avg_translate_bleu"] = np.mean(translate_bleu)
-        if translate_chrf:
-            metrics["avg_translate_chrf"] = np.mean(translate_chrf)
-        
-        return metrics
+        pred_str = preprocess_batch(tokenizer.batch_decode(pred_ids, skip_special_tokens=True))
+        label_str = preprocess_batch(tokenizer.batch_decode(label_ids, skip_special_tokens=True))
+
+        # The first and second label tokens are the language and the task of each sequence
+        return compute_grouped_metrics(pred_str, label_str, label_ids[:, :2], group_names)
+
+    def preprocess_logits_for_metrics(logits, labels):
+        """Reduce teacher-forced logits to the most likely token and the loss at every label position"""
+        # the other outputs, e.g. the encoder states, would otherwise be gathered for the whole eval set
+        logits = logits[0] if isinstance(logits, tuple) else logits
+        token_losses = torch.nn.functional.cross_entropy(logits.transpose(1, 2).float(), labels, reduction="none")
+        return logits.argmax(-1), token_losses
+
+    def compute_teacher_forced(pred):
+        pred_ids, token_losses = pred.predictions
+        # the labels start after <|startoftranscript|>
+        return compute_teacher_forced_metrics(
+            pred_ids, token_losses, pred.label_ids, group_names, tokenizer, prefix_length=prefix_length - 1
+        )
 
     # 9. Create a single speech processor
     # make sure all processes wait until data is saved
@@ -732,14 +2168,112 @@ def main():
     processor = AutoProcessor.from_pretrained(training_args.output_dir)
 
     # 10. Define data collator
-    data_collator = DataCollatorSpeechSeq2SeqWithPadding(
-        processor=processor,
-        decoder_start_token_id=model.config.decoder_start_token_id,
-        forward_attention_mask=forward_attention_mask,
-    )
+    if data_args.streaming_features:
+        data_collator = DataCollatorSpeechSeq2SeqWithFeatureExtraction(
+            processor=processor,
+            decoder_start_token_id=model.config.decoder_start_token_id,
+            forward_attention_mask=forward_attention_mask,
+            frame_buckets=frame_buckets,
+            return_input_length=data_args.eval_max_new_tokens_per_second is not None,
+            audio_column_name=audio_column_name,
+            pcm_cache=pcm_cache,
+        )
+    else:
+        data_collator = DataCollatorSpeechSeq2SeqWithStacking(
+            processor=processor,
+            decoder_start_token_id=model.config.decoder_start_token_id,
+            forward_attention_mask=forward_attention_mask,
+            frame_buckets=frame_buckets,
+            return_input_length=data_args.eval_max_new_tokens_per_second is not None,
+        )
+
+    if data_args.share_encoder_across_tasks:
+        data_collator = DataCollatorSpeechSeq2SeqMultiTask(collator=data_collator)
+
+    if model_args.teacher_model_name_or_path is not None and training_args.do_train:
+        # The teacher runs once over the training set, teacher-forced on the labels. Its top-k logits are added to
+        # the training index, so later epochs and reruns with the same teacher and inputs read them from the datasets
+        # cache. The teacher is only loaded by a process that computes them.
+        teacher_kwargs = {
+            "cache_dir": model_args.cache_dir,
+            "token": model_args.token,
+            "trust_remote_code": model_args.trust_remote_code,
+        }
+        teacher_config = AutoConfig.from_pretrained(model_args.teacher_model_name_or_path, **teacher_kwargs)
+        if teacher_config.vocab_size != model.config.vocab_size:
+            raise ValueError(
+                f"The teacher {model_args.teacher_model_name_or_path} has a vocabulary of "
+                f"{teacher_config.vocab_size} tokens, the model {model.config.vocab_size}."
+            )
+        teacher = None
+
+        def teacher_top_k(batch, indices):
+            nonlocal teacher
+            if teacher is None:
+                teacher = AutoModelForSpeechSeq2Seq.from_pretrained(
+                    model_args.teacher_model_name_or_path, **teacher_kwargs
+                )
+                teacher = teacher.to(training_args.device).eval()
+                if frame_buckets is not None:
+                    enable_encoder_length_buckets(teacher)
+            return compute_teacher_top_k(teacher, train_dataset, indices, data_collator, model_args.distillation_top_k)
+
+        train_dataset = vectorized_datasets["train"]
+        with training_args.main_process_first(desc="teacher logits"):
+            teacher_index = train_dataset.index.map(
+                teacher_top_k,
+                batched=True,
+                batch_size=training_args.per_device_eval_batch_size,
+                with_indices=True,
+                load_from_cache_file=not data_args.overwrite_cache,
+                new_fingerprint=Hasher.hash(
+                    (
+                        train_dataset.index._fingerprint,
+                        # the encoder inputs: the cached features or audio, and how the collator turns them into mels
+                        train_dataset.features._fingerprint,
+                        data_args.streaming_features,
+                        forward_attention_mask,
+                        frame_buckets,
+                        checkpoint_signature(model_args.teacher_model_name_or_path, **teacher_kwargs),
+                        model_args.distillation_top_k,
+                        inspect.getsource(compute_teacher_top_k),
+                    )
+                ),
+                desc="cache teacher logits",
+            )
+        vectorized_datasets["train"] = MultiTaskSpeechDataset(
+            train_dataset.features, teacher_index, numpy_views=train_dataset.numpy_views
+        )
+        if teacher is not None:
+            teacher = None
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        data_collator = DataCollatorWithTeacherLogits(collator=data_collator)
+
+    if model_args.lora_rank is not None:
+        from peft import LoraConfig, get_peft_model
+
+        if training_args.gradient_checkpointing:
+            enable_input_require_grads(model)
+        lora_config = LoraConfig(
+            r=model_args.lora_rank,
+            lora_alpha=model_args.lora_alpha or 2 * model_args.lora_rank,
+            lora_dropout=model_args.lora_dropout,
+            target_modules=model_args.lora_target_modules.split(","),
+        )
+        model = get_peft_model(model, lora_config)
+        trainable, total = model.get_nb_trainable_parameters()
+        logger.info(f"LoRA rank {model_args.lora_rank}: training {trainable:,} of {total:,} parameters")
 
     # 11. Initialize Trainer
-    trainer = Seq2SeqTrainer(
+    # The datasets above yield exactly what the data collators read, including columns the model does not take
+    # (raw audio, int8 feature scales), so the Trainer must not strip them
+    training_args.remove_unused_columns = False
+    if data_args.share_encoder_across_tasks and training_args.ddp_find_unused_parameters is None:
+        # the two decoder passes of a training step share one backward pass, which DDP only supports without
+        # searching the graph of every forward pass for unused parameters
+        training_args.ddp_find_unused_parameters = False
+    trainer = MultiTaskSeq2SeqTrainer(
         model=model,
         args=training_args,
         train_dataset=vectorized_datasets["train"] if training_args.do_train else None,
@@ -747,6 +2281,16 @@ def main():
         processing_class=feature_extractor,
         data_collator=data_collator,
         compute_metrics=compute_metrics if training_args.predict_with_generate else None,
+        max_tokens_per_batch=data_args.max_tokens_per_batch,
+        sort_eval_by_length=data_args.sort_eval_by_length,
+        max_new_tokens_per_second=data_args.eval_max_new_tokens_per_second,
+        prediction_cache_dir=data_args.eval_prediction_cache_dir,
+        teacher_forced_metrics=compute_teacher_forced if data_args.teacher_forced_eval else None,
+        teacher_forced_preprocess_logits=preprocess_logits_for_metrics,
+        generate_eval_steps=data_args.generate_eval_steps,
+        assistant_model=assistant_model,
+        distillation_kl_weight=model_args.distillation_kl_weight,
+        distillation_temperature=model_args.distillation_temperature,
     )
 
     # 12. Training
@@ -0,0 +1,187 @@
+"""Pre-decoded 16 kHz PCM audio cache.
+
+Decoding the Telegram opus/mp3 recordings and resampling them to 16 kHz is the slowest step of preprocessing and of
+on-the-fly feature extraction. This module decodes every clip once, on a process pool, and appends it as int16 PCM
+to large shard files with an offset index. Later reads are memory-mapped slices and decode nothing.
+
+The cache is append-only: building it again only decodes clips whose key is not in the index yet, so an interrupted
+build resumes where it stopped and new recordings are added incrementally. Clips are keyed by a hash of their encoded
+bytes (see `audio_key`), so the same recording is never decoded twice.
+
+    python pcm_cache.py --cache_dir ./pcm_cache --languages hawrami gilaki --num_workers 8
+"""
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import librosa
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "index.jsonl"
+METADATA_FILE = "pcm_cache.json"
+
+
+def audio_key(audio):
+    """Content hash of an undecoded `datasets.Audio` value, i.e. a dict with the keys `bytes` and `path`."""
+    if audio.get("bytes") is not None:
+        return hashlib.sha1(audio["bytes"]).hexdigest()
+    with open(audio["path"], "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def decode_audio(audio, sampling_rate):
+    """Decodes and resamples one undecoded `datasets.Audio` value to mono int16 PCM."""
+    source = io.BytesIO(audio["bytes"]) if audio.get("bytes") is not None else audio["path"]
+    array, _ = librosa.load(source, sr=sampling_rate, mono=True)
+    return np.clip(np.rint(array * 32767), -32768, 32767).astype(np.int16)
+
+
+class PCMCache:
+    """
+    Append-only store of int16 PCM clips in memory-mapped shards.
+    Args:
+        cache_dir (`str`)
+            Directory holding the shards, the offset index and the cache metadata.
+        sampling_rate (`int`)
+            Sampling rate of the stored PCM. Opening an existing cache with another rate raises an error.
+        shard_size (`int`)
+            Size in bytes after which a new shard file is started.
+        read_only (`bool`, *optional*, defaults to `False`)
+            Whether to open an existing cache for reading only, e.g. on every process of a distributed run but the
+            one that builds it. `add` then raises an error.
+    """
+
+    def __init__(self, cache_dir, sampling_rate=16000, shard_size=2**30, read_only=False):
+        self.cache_dir = cache_dir
+        self.sampling_rate = sampling_rate
+        self.shard_size = shard_size
+        self.read_only = read_only
+        if not read_only:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        metadata_path = os.path.join(cache_dir, METADATA_FILE)
+        if read_only and not os.path.exists(metadata_path):
+            raise ValueError(f"There is no PCM cache at {cache_dir} to open read-only.")
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+            if metadata["sampling_rate"] != sampling_rate:
+                raise ValueError(
+                    f"The PCM cache at {cache_dir} holds audio at {metadata['sampling_rate']} Hz, "
+                    f"but {sampling_rate} Hz was requested."
+                )
+        else:
+            with open(metadata_path, "w") as f:
+                json.dump({"sampling_rate": sampling_rate, "dtype": "int16"}, f)
+
+        # key -> (shard, offset, length), offsets and lengths in samples
+        self.index = {}
+        index_path = os.path.join(cache_dir, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # last line of an interrupted build
+                        continue
+                    self.index[entry["key"]] = (entry["shard"], entry["offset"], entry["length"])
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __getstate__(self):
+        # memory maps are reopened lazily in every dataloader worker
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
+
+    def _shard_path(self, shard):
+        return os.path.join(self.cache_dir, f"shard-{shard:05d}.pcm")
+
+    def load(self, key):
+        """Returns the clip stored under `key` as a float32 array in [-1, 1]."""
+        shard, offset, length = self.index[key]
+        samples = self._shards.get(shard)
+        if samples is None or offset + length > len(samples):
+            samples = self._shards[shard] = np.memmap(self._shard_path(shard), dtype=np.int16, mode="r")
+        return samples[offset : offset + length].astype(np.float32) / 32768.0
+
+    def add(self, audios, num_workers=None, chunk_size=256):
+        """
+        Decodes the undecoded `datasets.Audio` values of `audios` whose key is not cached yet and appends them to the
+        cache. Decoding runs on a pool of `num_workers` processes, `chunk_size` clips at a time. Returns the number
+        of clips added.
+        """
+        if self.read_only:
+            raise ValueError(f"The PCM cache at {self.cache_dir} was opened read-only.")
+        audios = iter(audios)
+        shard = max((entry[0] for entry in self.index.values()), default=0)
+        added = 0
+        with ProcessPoolExecutor(max_workers=num_workers) as executor, open(
+            os.path.join(self.cache_dir, INDEX_FILE), "a"
+        ) as index_file:
+            while True:
+                batch = list(islice(audios, chunk_size))
+                if not batch:
+                    break
+                chunk = {}
+                for audio in batch:
+                    key = audio_key(audio)
+                    if key not in self.index:
+                        chunk[key] = audio
+                decoded = executor.map(decode_audio, chunk.values(), [self.sampling_rate] * len(chunk))
+                for key, pcm in zip(chunk, decoded):
+                    path = self._shard_path(shard)
+                    if os.path.exists(path) and os.path.getsize(path) >= self.shard_size:
+                        shard += 1
+                        path = self._shard_path(shard)
+                    with open(path, "ab") as f:
+                        offset = f.tell() // 2
+                        f.write(pcm.tobytes())
+                    self.index[key] = (shard, offset, len(pcm))
+                    index_file.write(json.dumps({"key": key, "shard": shard, "offset": offset, "length": len(pcm)}))
+                    index_file.write("\n")
+                    index_file.flush()
+                    added += 1
+        return added
+
+
+def main():
+    from datasets import Audio, load_dataset
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cache_dir", required=True)
+    parser.add_argument("--dataset_name", default="razhan/DOLMA-speech")
+    parser.add_argument("--languages", nargs="+", required=True, help="Dataset configs to decode.")
+    parser.add_argument("--splits", nargs="+", default=["train", "test"])
+    parser.add_argument("--audio_column_name", default="audio")
+    parser.add_argument("--sampling_rate", type=int, default=16000)
+    parser.add_argument("--num_workers", type=int, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    cache = PCMCache(args.cache_dir, sampling_rate=args.sampling_rate)
+    for lang_name in args.languages:
+        for split in args.splits:
+            dataset = load_dataset(args.dataset_name, lang_name, split=split)
+            dataset = dataset.select_columns([args.audio_column_name])
+            dataset = dataset.cast_column(args.audio_column_name, Audio(decode=False))
+            added = cache.add((row[args.audio_column_name] for row in dataset), num_workers=args.num_workers)
+            logger.info(f"{lang_name} {split}: decoded {added} new clips, {len(cache)} clips cached in total")
+
+
+if __name__ == "__main__":
+    main()
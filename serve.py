@@ -0,0 +1,230 @@
+"""HTTP inference server with dynamic micro-batching for checkpoints fine-tuned by finetune_whisper.py.
+
+The model is loaded once. Every request posts the bytes of one audio file in any format librosa reads (e.g. the
+ogg/opus voice messages of the Telegram bot) and names its language and task in the query string:
+
+    python serve.py --model_name_or_path ./whisper-base-me --port 8000 --max_batch_size 16 --max_wait_ms 20
+    curl --data-binary @voice.ogg "http://localhost:8000/transcribe?language=hawrami&task=translate"
+
+Requests are decoded on a thread pool and their 30 second windows are queued. A batch is cut from the queue as soon
+as it holds `--max_batch_size` windows or `--max_wait_ms` after its first window arrived, and the windows of a batch
+run through one `generate` per task, each clip with its own language token. While the model runs, new requests
+queue up for the next batch, so batches grow with the load. `GET /metrics` reports the p50/p99 latency and the
+histogram of batch sizes. With `--adapters`, the windows of every language run with the LoRA adapter of their
+language on the one loaded model.
+"""
+import argparse
+import asyncio
+import io
+import logging
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import librosa
+import numpy as np
+import torch
+from aiohttp import web
+
+from transcribe import Transcriber, language_code, stitch_chunks, window_features
+
+
+logger = logging.getLogger(__name__)
+
+TASKS = ("transcribe", "translate")
+
+
+class MicroBatcher:
+    """
+    Queue of windows to transcribe, cut into batches by `max_batch_size` and `max_wait_ms`.
+    Args:
+        transcriber ([`Transcriber`])
+            The loaded model.
+        max_batch_size (`int`)
+            Maximum number of windows per batch.
+        max_wait_ms (`float`)
+            How long the first window of a batch waits for others.
+    """
+
+    def __init__(self, transcriber, max_batch_size=16, max_wait_ms=20.0):
+        self.transcriber = transcriber
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        # `generate` runs on a single thread next to the event loop
+        self._model_executor = ThreadPoolExecutor(max_workers=1)
+        self.latencies = deque(maxlen=10000)
+        self.batch_sizes = Counter()
+        self.num_requests = 0
+
+    async def submit(self, chunks, language, task):
+        """Queues the windows of one clip and returns the generated token ids of each of them."""
+        loop = asyncio.get_running_loop()
+        futures = []
+        for chunk in chunks:
+            future = loop.create_future()
+            self.queue.put_nowait((chunk, language_code(language), task, future))
+            futures.append(future)
+        return await asyncio.gather(*futures)
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+        jobs = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(jobs) < self.max_batch_size:
+            if not self.queue.empty():
+                jobs.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                jobs.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return jobs
+
+    def generate(self, jobs, task):
+        input_features = self.transcriber.stack_features([chunk for chunk, _, _, _ in jobs])
+        return self.transcriber.generate(input_features, [language for _, language, _, _ in jobs], task)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            jobs = await self.next_batch()
+            self.batch_sizes[len(jobs)] += 1
+            tasks = defaultdict(list)
+            for job in jobs:
+                tasks[job[2]].append(job)
+            for task, task_jobs in tasks.items():
+                try:
+                    token_ids = await loop.run_in_executor(self._model_executor, self.generate, task_jobs, task)
+                except Exception as error:
+                    logger.exception(f"Generation failed for a batch of {len(task_jobs)} windows")
+                    token_ids = [error] * len(task_jobs)
+                for (_, _, _, future), result in zip(task_jobs, token_ids):
+                    # the client may have gone away
+                    if future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+
+    def metrics(self):
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        num_batches = sum(self.batch_sizes.values())
+        return {
+            "requests": self.num_requests,
+            "queued_windows": self.queue.qsize(),
+            "latency_p50": float(np.percentile(latencies, 50)),
+            "latency_p99": float(np.percentile(latencies, 99)),
+            "batches": num_batches,
+            "mean_batch_size": sum(size * count for size, count in self.batch_sizes.items()) / max(num_batches, 1),
+            "batch_size_histogram": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+        }
+
+
+def build_app(
+    transcriber, max_batch_size=16, max_wait_ms=20.0, num_workers=4, chunk_length_s=30.0, chunk_overlap_s=5.0
+):
+    """aiohttp application serving `transcriber` (see the module docstring)."""
+    if not 0 <= chunk_overlap_s < chunk_length_s:
+        raise ValueError(
+            f"`chunk_overlap_s` must be at least 0 and shorter than `chunk_length_s` ({chunk_length_s}), "
+            f"got {chunk_overlap_s}."
+        )
+    batcher = MicroBatcher(transcriber, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    decode_executor = ThreadPoolExecutor(max_workers=num_workers)
+    feature_extractor = transcriber.processor.feature_extractor
+
+    def decode(body):
+        array, _ = librosa.load(io.BytesIO(body), sr=feature_extractor.sampling_rate, mono=True)
+        return window_features(array, feature_extractor, chunk_length_s, chunk_overlap_s), len(array)
+
+    async def transcribe(request):
+        start = time.perf_counter()
+        language = request.query.get("language")
+        task = request.query.get("task", "transcribe")
+        if language is None or task not in TASKS:
+            raise web.HTTPBadRequest(text=f"Pass `language` and a `task` out of {TASKS} in the query string.")
+        body = await request.read()
+        try:
+            chunks, num_samples = await asyncio.get_running_loop().run_in_executor(decode_executor, decode, body)
+        except Exception as error:
+            raise web.HTTPBadRequest(text=f"Could not decode the audio: {error}")
+        token_ids = await batcher.submit(chunks, language, task)
+        latency = time.perf_counter() - start
+        batcher.latencies.append(latency)
+        batcher.num_requests += 1
+        return web.json_response(
+            {
+                "text": transcriber.decode(stitch_chunks(token_ids)),
+                "language": language,
+                "task": task,
+                "duration": num_samples / feature_extractor.sampling_rate,
+                "latency": latency,
+            }
+        )
+
+    async def metrics(request):
+        return web.json_response(batcher.metrics())
+
+    async def health(request):
+        return web.json_response({"status": "ok"})
+
+    async def start_batcher(app):
+        app["batcher_task"] = asyncio.create_task(batcher.run())
+
+    async def stop_batcher(app):
+        app["batcher_task"].cancel()
+        decode_executor.shutdown(wait=False)
+
+    app = web.Application(client_max_size=64 * 2**20)
+    app.add_routes([web.post("/transcribe", transcribe), web.get("/metrics", metrics), web.get("/health", health)])
+    app.on_startup.append(start_batcher)
+    app.on_cleanup.append(stop_batcher)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model_name_or_path", required=True)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch_size", type=int, default=16, help="Maximum number of windows per batch.")
+    parser.add_argument("--max_wait_ms", type=float, default=20.0, help="How long a batch waits to fill up.")
+    parser.add_argument("--num_workers", type=int, default=4, help="Threads decoding audio.")
+    parser.add_argument("--num_beams", type=int, default=1)
+    parser.add_argument("--max_new_tokens", type=int, default=225)
+    parser.add_argument(
+        "--encoder_length_buckets", default=None, help="Comma separated bucket durations in seconds, e.g. 10,20,30."
+    )
+    parser.add_argument(
+        "--adapters", nargs="*", default=[], help="LoRA adapters by language, e.g. hawrami=./lora-hawrami."
+    )
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--num_threads", type=int, default=None, help="Torch intra-op threads on CPU.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    transcriber = Transcriber(
+        args.model_name_or_path,
+        device=args.device,
+        num_beams=args.num_beams,
+        max_new_tokens=args.max_new_tokens,
+        encoder_length_buckets=[float(seconds) for seconds in args.encoder_length_buckets.split(",")]
+        if args.encoder_length_buckets
+        else None,
+        adapters=dict(adapter.split("=", 1) for adapter in args.adapters),
+    )
+    app = build_app(
+        transcriber, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms, num_workers=args.num_workers
+    )
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
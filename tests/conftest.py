@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+
+# the scripts of the repository are imported as top-level modules, like the benchmarks do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def tiny_whisper():
+    """A randomly initialised Whisper model with the input and positional sizes of the real ones."""
+    torch = pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+    config = transformers.WhisperConfig(
+        d_model=16,
+        encoder_layers=1,
+        decoder_layers=1,
+        encoder_attention_heads=2,
+        decoder_attention_heads=2,
+        encoder_ffn_dim=32,
+        decoder_ffn_dim=32,
+        max_target_positions=32,
+    )
+    torch.manual_seed(0)
+    return transformers.WhisperForConditionalGeneration(config).eval()
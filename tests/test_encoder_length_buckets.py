@@ -0,0 +1,41 @@
+import copy
+
+import pytest
+
+
+torch = pytest.importorskip("torch")
+
+from whisper_utils import enable_encoder_length_buckets  # noqa: E402
+
+
+@pytest.mark.parametrize("num_frames", [1000, 2000])
+def test_short_bucket_runs_through_encoder(tiny_whisper, num_frames):
+    model = tiny_whisper
+    reference = copy.deepcopy(model)
+    enable_encoder_length_buckets(model)
+    input_features = torch.randn(2, model.config.num_mel_bins, num_frames)
+
+    with torch.no_grad():
+        hidden_states = model.get_encoder()(input_features).last_hidden_state
+
+    assert hidden_states.shape == (2, num_frames // 2, model.config.d_model)
+    # the first positions of a short input get the same embeddings as in a 30 second one
+    embed_positions = reference.get_encoder().embed_positions.weight
+    assert torch.equal(model.get_encoder().embed_positions.weight, embed_positions[: num_frames // 2])
+
+
+def test_full_window_and_weights_are_unchanged(tiny_whisper):
+    model = tiny_whisper
+    reference = copy.deepcopy(model)
+    enable_encoder_length_buckets(model)
+    input_features = torch.randn(1, model.config.num_mel_bins, 2 * model.config.max_source_positions)
+
+    with torch.no_grad():
+        # a short batch first, so the embedding has been cut before
+        model.get_encoder()(input_features[..., :1000])
+        hidden_states = model.get_encoder()(input_features).last_hidden_state
+        expected = reference.get_encoder()(input_features).last_hidden_state
+
+    torch.testing.assert_close(hidden_states, expected)
+    assert model.state_dict().keys() == reference.state_dict().keys()
+    assert model.get_encoder().embed_positions.num_embeddings == model.config.max_source_positions
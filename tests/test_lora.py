@@ -0,0 +1,40 @@
+import pytest
+
+
+torch = pytest.importorskip("torch")
+peft = pytest.importorskip("peft")
+
+from finetune_whisper import enable_input_require_grads  # noqa: E402
+
+
+def hook_decoder_embeddings_only(model):
+    """`enable_input_require_grads` as in transformers 4.x, which only hooks `get_input_embeddings()`."""
+
+    def make_output_require_grad(module, args, output):
+        output.requires_grad_(True)
+
+    model.get_input_embeddings().register_forward_hook(make_output_require_grad)
+
+
+def test_encoder_adapters_get_gradients_with_gradient_checkpointing(tiny_whisper, monkeypatch):
+    model = tiny_whisper
+    monkeypatch.setattr(model, "enable_input_require_grads", lambda: hook_decoder_embeddings_only(model))
+    model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": True})
+    enable_input_require_grads(model)
+    model = peft.get_peft_model(model, peft.LoraConfig(r=4, target_modules=["q_proj", "v_proj", "fc1", "fc2"]))
+    # lora_B starts at zero, which leaves lora_A without gradient
+    for name, param in model.named_parameters():
+        if "lora_B" in name:
+            torch.nn.init.normal_(param, std=0.1)
+    model.train()
+
+    input_features = torch.randn(2, model.config.num_mel_bins, 2 * model.config.max_source_positions)
+    labels = torch.randint(0, 100, (2, 6))
+    model(input_features=input_features, labels=labels).loss.backward()
+
+    encoder_adapters = {
+        name: param for name, param in model.named_parameters() if ".encoder." in name and "lora_" in name
+    }
+    assert encoder_adapters
+    for name, param in encoder_adapters.items():
+        assert param.grad is not None and param.grad.abs().sum() > 0, name
@@ -0,0 +1,46 @@
+import pytest
+
+
+np = pytest.importorskip("numpy")
+sacrebleu = pytest.importorskip("sacrebleu")
+
+from finetune_whisper import compute_grouped_metrics  # noqa: E402
+
+
+PREDICTIONS = [
+    "the cat sat on the mat",
+    "a dog runs in the park",
+    "hello there",
+    "we went to the market yesterday",
+    "it is raining today",
+    "my brother works in the city",
+]
+REFERENCES = [
+    "the cat sat on a mat",
+    "the dog runs in the park",
+    "hello there friend",
+    "yesterday we went to the market",
+    "it rains today",
+    "my brother works in the city",
+]
+# (language token, task token) of every row, see `group_rows`
+GROUP_KEYS = np.array([[1, 9], [1, 9], [2, 9], [2, 9], [2, 9], [1, 8]])
+GROUP_NAMES = {(1, 9): ("hawrami", "translate"), (2, 9): ("gilaki", "translate"), (1, 8): ("hawrami", "transcribe")}
+
+
+def test_grouped_translation_scores_match_sacrebleu():
+    metrics = compute_grouped_metrics(PREDICTIONS, REFERENCES, GROUP_KEYS, GROUP_NAMES)
+
+    for lang_name, rows in (("hawrami", [0, 1]), ("gilaki", [2, 3, 4])):
+        predictions = [PREDICTIONS[i] for i in rows]
+        references = [REFERENCES[i] for i in rows]
+        assert metrics[f"{lang_name}_bleu"] == pytest.approx(sacrebleu.corpus_bleu(predictions, [references]).score)
+        assert metrics[f"{lang_name}_chrf"] == pytest.approx(sacrebleu.corpus_chrf(predictions, [references]).score)
+
+    # the averages are corpus scores over the rows of all languages
+    rows = [0, 1, 2, 3, 4]
+    predictions = [PREDICTIONS[i] for i in rows]
+    references = [REFERENCES[i] for i in rows]
+    assert metrics["avg_translate_bleu"] == pytest.approx(sacrebleu.corpus_bleu(predictions, [references]).score)
+    assert metrics["avg_translate_chrf"] == pytest.approx(sacrebleu.corpus_chrf(predictions, [references]).score)
+    assert metrics["hawrami_wer"] == 0.0
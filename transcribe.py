@@ -0,0 +1,457 @@
+"""Batched inference with a checkpoint fine-tuned by finetune_whisper.py.
+
+Transcribes and/or translates every audio file of a directory, or of a manifest such as the `metadata.csv` that the
+Telegram bot writes next to its recordings (`dataset/<lang>/metadata.csv`), and streams one JSON line per file:
+
+    python transcribe.py --model_name_or_path ./whisper-base-me --input dataset/hawrami/metadata.csv \\
+        --tasks transcribe translate --output hawrami.jsonl
+    python transcribe.py --model_name_or_path ./whisper-base-me --input recordings/ --language gilaki \\
+        --output gilaki.jsonl
+
+Files are batched in order of their duration (the `duration` column of a manifest, otherwise the file size), so the
+clips of a batch are of similar length. They are decoded and turned into log-mel features on a thread pool a few
+batches ahead of the model, so decoding overlaps with `generate`. Every line holds the predictions of one file with
+the time spent decoding it and its share of the generation time of its batch.
+
+Recordings longer than `--chunk_length_s` (interviews, radio) are cut into windows overlapping by
+`--chunk_overlap_s`, which are batched like short clips. A line with `"partial": true` is written for every window as
+soon as its batch is done, and the predictions of the windows are stitched into the line of the file where their
+tokens agree in the overlap.
+
+With `--assistant_model_name_or_path`, a small draft model (e.g. whisper-tiny fine-tuned on the same languages)
+proposes tokens that the model checks in a single forward pass. The output is that of greedy decoding, windows are
+generated one at a time, and the log reports the share of drafted tokens that were accepted.
+
+With `--adapters hawrami=./lora-hawrami gilaki=./lora-gilaki`, LoRA adapters trained with `--lora_rank` are loaded
+onto the model given by `--model_name_or_path`, e.g. openai/whisper-base, and every batch runs each language with
+its own adapter.
+"""
+import argparse
+import contextlib
+import csv
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import librosa
+import numpy as np
+import torch
+from transformers import AutoConfig, AutoModelForSpeechSeq2Seq, AutoProcessor, GenerationConfig
+
+from export_whisper import INT8_WEIGHTS_NAME, ONNX_FILE_NAMES, quantize_dynamic_int8
+from whisper_utils import LANGUAGES, AssistedGenerationStats, enable_encoder_length_buckets
+
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".ogg", ".oga", ".opus", ".flac", ".m4a")
+
+
+def language_code(language):
+    """Whisper language code of a DOLMA-speech config name (e.g. `hawrami`), or `language` itself."""
+    return LANGUAGES.get(language, language)
+
+
+def list_inputs(path, language=None):
+    """
+    Lists the audio files to transcribe as dicts with the keys `path`, `file_name`, `language` and `length`, a
+    number to sort by duration. `path` is a directory, searched recursively, or a CSV manifest with a `file_name`
+    column relative to it and optional `language` and `duration` columns. `language` overrides the manifest.
+    """
+    items = []
+    if os.path.isdir(path):
+        if language is None:
+            raise ValueError("`--language` is required to transcribe a directory.")
+        for root, _, file_names in os.walk(path):
+            for file_name in sorted(file_names):
+                if file_name.lower().endswith(AUDIO_EXTENSIONS):
+                    file_path = os.path.join(root, file_name)
+                    items.append(
+                        {
+                            "path": file_path,
+                            "file_name": os.path.relpath(file_path, path),
+                            "language": language,
+                            # compressed size is close enough to the duration for batching
+                            "length": os.path.getsize(file_path),
+                        }
+                    )
+        return items
+
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            if language is None and not row.get("language"):
+                raise ValueError(f"{path} has no `language` column, pass `--language`.")
+            file_path = os.path.join(os.path.dirname(path), row["file_name"])
+            items.append(
+                {
+                    "path": file_path,
+                    "file_name": row["file_name"],
+                    "language": language or row["language"],
+                    "length": float(row["duration"]) if row.get("duration") else os.path.getsize(file_path),
+                }
+            )
+    return items
+
+
+def window_starts(num_samples, chunk_samples, stride_samples):
+    """Start samples of the windows of `chunk_samples`, every `stride_samples`, that cover `num_samples` samples."""
+    if stride_samples <= 0:
+        raise ValueError(f"Windows of {chunk_samples} samples need a positive stride, got {stride_samples}.")
+    starts = [0]
+    while starts[-1] + chunk_samples < num_samples:
+        starts.append(starts[-1] + stride_samples)
+    return starts
+
+
+def window_features(array, feature_extractor, chunk_length_s=30.0, chunk_overlap_s=5.0):
+    """
+    Log-mel features of the windows of `chunk_length_s` seconds of a decoded clip, overlapping by `chunk_overlap_s`
+    seconds, a single one for clips up to `chunk_length_s`. Returns a list of dicts with the keys `start`,
+    `duration` and `input_features`.
+    """
+    sampling_rate = feature_extractor.sampling_rate
+    chunk_samples = int(chunk_length_s * sampling_rate)
+    starts = window_starts(len(array), chunk_samples, int((chunk_length_s - chunk_overlap_s) * sampling_rate))
+    windows = [array[offset : offset + chunk_samples] for offset in starts]
+    input_features = feature_extractor(windows, sampling_rate=sampling_rate)["input_features"]
+    return [
+        {"start": offset / sampling_rate, "duration": len(window) / sampling_rate, "input_features": features}
+        for offset, window, features in zip(starts, windows, input_features)
+    ]
+
+
+def load_features(item, feature_extractor, chunk_length_s=30.0, chunk_overlap_s=5.0):
+    """Decodes one file and computes the features of its windows (`window_features`) on a decoding thread."""
+    start = time.perf_counter()
+    array, _ = librosa.load(item["path"], sr=feature_extractor.sampling_rate, mono=True)
+    return {
+        **item,
+        "chunks": window_features(array, feature_extractor, chunk_length_s, chunk_overlap_s),
+        "duration": len(array) / feature_extractor.sampling_rate,
+        "decode_seconds": time.perf_counter() - start,
+    }
+
+
+def prefetch(executor, fn, items, depth):
+    """Yields `fn(item)` for every item in order, keeping `depth` items in flight on `executor`."""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) > depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def chunk_batches(examples, batch_size):
+    """Cuts the windows of consecutive files into batches of `(example, chunk_idx)` pairs of `batch_size`."""
+    batch = []
+    for example in examples:
+        for chunk_idx in range(len(example["chunks"])):
+            batch.append((example, chunk_idx))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def stitch_chunks(sequences):
+    """
+    Merges the token ids of consecutive overlapping windows. The end of the text so far is aligned with the start of
+    the next window at the shift with the most equal tokens (at least two), and the two are joined in the middle of
+    the aligned span, where neither window was cut mid-word. Windows without such an alignment are appended whole.
+    """
+    merged = list(sequences[0])
+    for sequence in sequences[1:]:
+        best_score, best_overlap = 0.0, 0
+        for overlap in range(1, min(len(merged), len(sequence)) + 1):
+            matches = sum(left == right for left, right in zip(merged[-overlap:], sequence[:overlap]))
+            # between equal shares of matching tokens, prefer the longer alignment
+            score = matches / overlap + overlap * 1e-4
+            if matches > 1 and score > best_score:
+                best_score, best_overlap = score, overlap
+        middle = best_overlap // 2
+        merged = merged[: len(merged) - best_overlap + middle] + list(sequence[middle:])
+    return merged
+
+
+def load_model(model_name_or_path, device="cpu"):
+    """
+    Loads a checkpoint of finetune_whisper.py, or an export of export_whisper.py: int8 weights of a dynamically
+    quantised model, or ONNX graphs run with onnxruntime. Both exports run on CPU only.
+    """
+    if os.path.isfile(os.path.join(model_name_or_path, INT8_WEIGHTS_NAME)):
+        if device != "cpu":
+            raise ValueError(f"{model_name_or_path} holds a dynamically quantised model, which runs on CPU only.")
+        model = AutoModelForSpeechSeq2Seq.from_config(AutoConfig.from_pretrained(model_name_or_path))
+        model = quantize_dynamic_int8(model)
+        model.load_state_dict(torch.load(os.path.join(model_name_or_path, INT8_WEIGHTS_NAME), weights_only=True))
+        model.generation_config = GenerationConfig.from_pretrained(model_name_or_path)
+        return model.eval()
+    if os.path.isfile(os.path.join(model_name_or_path, ONNX_FILE_NAMES[0])):
+        if device != "cpu":
+            raise ValueError(f"{model_name_or_path} holds ONNX graphs, which run on CPU only.")
+        from optimum.onnxruntime import ORTModelForSpeechSeq2Seq
+
+        return ORTModelForSpeechSeq2Seq.from_pretrained(model_name_or_path, use_cache=True)
+    return AutoModelForSpeechSeq2Seq.from_pretrained(model_name_or_path).to(device).eval()
+
+
+class Transcriber:
+    """
+    Batched `generate` with a checkpoint of finetune_whisper.py.
+    Args:
+        model_name_or_path (`str`)
+            Output directory of finetune_whisper.py or export_whisper.py, or a model on the Hub.
+        device (`str`)
+            Device to run the model on.
+        num_beams (`int`)
+            Beam size of `generate`.
+        max_new_tokens (`int`)
+            Maximum number of generated tokens per clip.
+        encoder_length_buckets (`List[float]`, *optional*)
+            Durations in seconds to trim the batches to, as with `--encoder_length_buckets` in training.
+        assistant_model_name_or_path (`str`, *optional*)
+            Draft model for assisted generation, e.g. a whisper-tiny fine-tuned on the same languages. Windows are
+            then generated one at a time, greedily, and `assisted_stats` counts the accepted drafts.
+        adapters (`Dict[str, str]`, *optional*)
+            LoRA adapters trained with `finetune_whisper.py --lora_rank` on the model, by language. They are all
+            loaded onto the one model, and the windows of every language run with the adapter of their language, or
+            without an adapter for languages that have none.
+    """
+
+    def __init__(
+        self,
+        model_name_or_path,
+        device="cpu",
+        num_beams=1,
+        max_new_tokens=225,
+        encoder_length_buckets=None,
+        assistant_model_name_or_path=None,
+        adapters=None,
+    ):
+        self.processor = AutoProcessor.from_pretrained(model_name_or_path)
+        self.model = load_model(model_name_or_path, device)
+        self.adapters = {}
+        if adapters:
+            if not isinstance(self.model, torch.nn.Module):
+                raise ValueError("LoRA adapters need a PyTorch model.")
+            from peft import PeftModel
+
+            for language, path in adapters.items():
+                adapter_name = language_code(language)
+                if not self.adapters:
+                    self.model = PeftModel.from_pretrained(self.model, path, adapter_name=adapter_name)
+                else:
+                    self.model.load_adapter(path, adapter_name=adapter_name)
+                self.adapters[adapter_name] = path
+            self.model.eval()
+        self.assistant_model = None
+        self.assisted_stats = None
+        if assistant_model_name_or_path is not None:
+            if num_beams != 1 or not isinstance(self.model, torch.nn.Module):
+                raise ValueError("Assisted generation needs greedy decoding (`num_beams` 1) with a PyTorch model.")
+            self.assistant_model = load_model(assistant_model_name_or_path, device)
+            self.assisted_stats = AssistedGenerationStats()
+        self.device = device
+        self.num_beams = num_beams
+        self.max_new_tokens = max_new_tokens
+        self.frame_buckets = None
+        if encoder_length_buckets:
+            if not isinstance(self.model, torch.nn.Module):
+                raise ValueError("`encoder_length_buckets` needs a PyTorch model, the ONNX encoder takes 30 seconds.")
+            feature_extractor = self.processor.feature_extractor
+            frames_per_second = feature_extractor.sampling_rate / feature_extractor.hop_length
+            self.frame_buckets = sorted(
+                {int(seconds * frames_per_second) // 2 * 2 for seconds in encoder_length_buckets}
+                | {feature_extractor.nb_max_frames}
+            )
+            enable_encoder_length_buckets(self.model)
+            if self.assistant_model is not None:
+                enable_encoder_length_buckets(self.assistant_model)
+
+    def stack_features(self, chunks):
+        """Stacks the features of a batch, trimmed to the smallest frame bucket that holds its longest window."""
+        input_features = np.stack([chunk["input_features"] for chunk in chunks])
+        if self.frame_buckets is not None:
+            feature_extractor = self.processor.feature_extractor
+            frames_per_second = feature_extractor.sampling_rate / feature_extractor.hop_length
+            num_frames = max(int(np.ceil(chunk["duration"] * frames_per_second)) for chunk in chunks)
+            bucket = next(frames for frames in self.frame_buckets if frames >= num_frames)
+            input_features = input_features[..., :bucket]
+        return torch.from_numpy(input_features).to(self.device, dtype=self.model.dtype)
+
+    @torch.inference_mode()
+    def generate(self, input_features, languages, task):
+        """Generated token ids of one batch of stacked features, with one language code per window."""
+        if not self.adapters:
+            generated = self.generate_rows(input_features, languages, task)
+        else:
+            # one `generate` per language, with the adapter of that language or without any
+            generated = [None] * len(languages)
+            for language in dict.fromkeys(languages):
+                rows = [i for i, row_language in enumerate(languages) if row_language == language]
+                if language in self.adapters:
+                    self.model.set_adapter(language)
+                    adapter_context = contextlib.nullcontext()
+                else:
+                    adapter_context = self.model.disable_adapter()
+                with adapter_context:
+                    for i, row in zip(rows, self.generate_rows(input_features[rows], [language] * len(rows), task)):
+                        generated[i] = row
+        special_ids = set(self.processor.tokenizer.all_special_ids)
+        return [[token for token in row if token not in special_ids] for row in generated]
+
+    def generate_rows(self, input_features, languages, task):
+        """Generated token ids, with special tokens, of `input_features` with the model as it is set up."""
+        gen_kwargs = {
+            "task": task,
+            "num_beams": self.num_beams,
+            "max_new_tokens": self.max_new_tokens,
+            "num_segment_frames": input_features.shape[-1],
+        }
+        if self.assistant_model is None:
+            generated = self.model.generate(input_features, language=languages, **gen_kwargs).tolist()
+        else:
+            # assisted generation takes batches of one
+            with self.assisted_stats.count_passes(self.model, self.assistant_model):
+                generated = [
+                    self.model.generate(
+                        features[None], language=language, assistant_model=self.assistant_model, **gen_kwargs
+                    )[0].tolist()
+                    for features, language in zip(input_features, languages)
+                ]
+            self.assisted_stats.add(generated, self.model.generation_config.eos_token_id)
+        return generated
+
+    def decode(self, token_ids):
+        return self.processor.decode(token_ids, skip_special_tokens=True).strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model_name_or_path", required=True)
+    parser.add_argument("--input", required=True, help="Directory of audio files or CSV manifest.")
+    parser.add_argument("--output", required=True, help="JSON lines file the predictions are appended to.")
+    parser.add_argument("--language", default=None, help="DOLMA-speech config or Whisper language code.")
+    parser.add_argument("--tasks", nargs="+", default=["transcribe"], choices=["transcribe", "translate"])
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--num_workers", type=int, default=4, help="Threads decoding audio.")
+    parser.add_argument("--prefetch_batches", type=int, default=2, help="Batches of files decoded ahead.")
+    parser.add_argument("--num_beams", type=int, default=1)
+    parser.add_argument("--max_new_tokens", type=int, default=225)
+    parser.add_argument(
+        "--encoder_length_buckets", default=None, help="Comma separated bucket durations in seconds, e.g. 10,20,30."
+    )
+    parser.add_argument("--chunk_length_s", type=float, default=30.0, help="Window length of long recordings.")
+    parser.add_argument("--chunk_overlap_s", type=float, default=5.0, help="Overlap of consecutive windows.")
+    parser.add_argument(
+        "--assistant_model_name_or_path", default=None, help="Draft model for assisted (speculative) decoding."
+    )
+    parser.add_argument(
+        "--adapters", nargs="*", default=[], help="LoRA adapters by language, e.g. hawrami=./lora-hawrami."
+    )
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--num_threads", type=int, default=None, help="Torch intra-op threads on CPU.")
+    args = parser.parse_args()
+    if not 0 <= args.chunk_overlap_s < args.chunk_length_s:
+        parser.error("`--chunk_overlap_s` must be at least 0 and shorter than `--chunk_length_s`.")
+    logging.basicConfig(level=logging.INFO)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    transcriber = Transcriber(
+        args.model_name_or_path,
+        device=args.device,
+        num_beams=args.num_beams,
+        max_new_tokens=args.max_new_tokens,
+        encoder_length_buckets=[float(seconds) for seconds in args.encoder_length_buckets.split(",")]
+        if args.encoder_length_buckets
+        else None,
+        assistant_model_name_or_path=args.assistant_model_name_or_path,
+        adapters=dict(adapter.split("=", 1) for adapter in args.adapters),
+    )
+
+    items = list_inputs(args.input, args.language)
+    # longest first, so that a batch that does not fit into memory fails right away
+    items.sort(key=lambda item: item["length"], reverse=True)
+    logger.info(f"Transcribing {len(items)} files on {args.device}")
+
+    def load(item):
+        return load_features(item, transcriber.processor.feature_extractor, args.chunk_length_s, args.chunk_overlap_s)
+
+    def write(record):
+        output.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    start = time.perf_counter()
+    num_files, audio_seconds = 0, 0.0
+    with ThreadPoolExecutor(max_workers=args.num_workers) as executor, open(args.output, "a") as output:
+        examples = prefetch(executor, load, items, args.prefetch_batches * args.batch_size)
+        for batch in chunk_batches(examples, args.batch_size):
+            chunks = [example["chunks"][chunk_idx] for example, chunk_idx in batch]
+            input_features = transcriber.stack_features(chunks)
+            languages = [language_code(example["language"]) for example, _ in batch]
+            batch_start = time.perf_counter()
+            for task in args.tasks:
+                for chunk, token_ids in zip(chunks, transcriber.generate(input_features, languages, task)):
+                    chunk[task] = token_ids
+            generate_seconds = (time.perf_counter() - batch_start) / len(batch)
+
+            for example, chunk_idx in batch:
+                example["generate_seconds"] = example.get("generate_seconds", 0.0) + generate_seconds
+                num_chunks = len(example["chunks"])
+                chunk = example["chunks"][chunk_idx]
+                if num_chunks > 1:
+                    write(
+                        {
+                            "file_name": example["file_name"],
+                            "partial": True,
+                            "chunk": chunk_idx,
+                            "num_chunks": num_chunks,
+                            "start": round(chunk["start"], 3),
+                            "end": round(chunk["start"] + chunk["duration"], 3),
+                            **{task: transcriber.decode(chunk[task]) for task in args.tasks},
+                        }
+                    )
+                if chunk_idx < num_chunks - 1:
+                    continue
+                # the last window of a file is done
+                write(
+                    {
+                        "file_name": example["file_name"],
+                        "language": example["language"],
+                        "duration": round(example["duration"], 3),
+                        **({"num_chunks": num_chunks} if num_chunks > 1 else {}),
+                        **{
+                            task: transcriber.decode(stitch_chunks([chunk[task] for chunk in example["chunks"]]))
+                            for task in args.tasks
+                        },
+                        "decode_seconds": round(example["decode_seconds"], 4),
+                        "generate_seconds": round(example["generate_seconds"], 4),
+                    }
+                )
+                num_files += 1
+                audio_seconds += example["duration"]
+                # the features of a file are not needed anymore once it is written
+                example["chunks"] = None
+            output.flush()
+
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f"{num_files} files ({audio_seconds / 3600:.2f} h of audio) in {elapsed:.1f} s: "
+        f"{num_files / elapsed:.2f} files/s, real-time factor {elapsed / max(audio_seconds, 1e-9):.4f}"
+    )
+    if transcriber.assisted_stats is not None:
+        stats = transcriber.assisted_stats.metrics()
+        logger.info(
+            f"Assisted generation: {stats['draft_acceptance_rate']:.1%} of the drafted tokens accepted, "
+            f"{stats['tokens_per_model_pass']:.2f} tokens per pass of the model"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Helpers shared by finetune_whisper.py and the inference scripts (transcribe.py, serve.py).
+
+Kept free of the training dependencies (datasets, klpt, sacrebleu, ...), so that inference only imports torch.
+"""
+import copy
+from contextlib import contextmanager
+from typing import Optional
+
+import torch
+
+
+# DOLMA-speech configs and the Whisper language token each of them is trained under
+LANGUAGES = {
+    "hawrami": "fa",
+    "gilaki": "de",
+    "zazaki": "es",
+    "mazanderani": "it",
+    "laki_kurdish": "fr",
+    "southern_kurdish": "nl",
+    "talysh": "pt",
+}
+
+
+class SlicedPositionalEmbedding(torch.nn.Embedding):
+    """
+    Positional embedding cut to its first `num_positions` rows (`--encoder_length_buckets`). Both its `weight`, read
+    directly by older versions of `WhisperEncoder.forward`, and its lookups, which newer versions make for the
+    positions `range(num_embeddings)`, are cut.
+    """
+
+    num_positions: Optional[int] = None
+
+    @property
+    def weight(self):
+        weight = self._parameters["weight"]
+        return weight if self.num_positions is None else weight[: self.num_positions]
+
+    def forward(self, input):
+        if self.num_positions is not None:
+            input = input[..., : self.num_positions]
+        return super().forward(input)
+
+
+def enable_encoder_length_buckets(model):
+    """
+    Lets the Whisper encoder of `model` run on mel inputs shorter than 30 seconds (`--encoder_length_buckets`). Its
+    positional embeddings are sliced to the length of every input, and its length check reads a private copy of
+    the config, so the parameters and the saved config of the model are unchanged.
+    """
+    encoder = model.get_encoder()
+    encoder.config = copy.copy(encoder.config)
+    encoder.embed_positions.__class__ = SlicedPositionalEmbedding
+    stride = encoder.conv1.stride[0] * encoder.conv2.stride[0]
+
+    def set_num_positions(module, args, kwargs):
+        input_features = args[0] if args else kwargs["input_features"]
+        module.config.max_source_positions = input_features.shape[-1] // stride
+        module.embed_positions.num_positions = input_features.shape[-1] // stride
+
+    encoder.register_forward_pre_hook(set_num_positions, with_kwargs=True)
+
+
+class AssistedGenerationStats:
+    """
+    Counts of assisted generation with a draft model (`--assistant_model_name_or_path`). Every decoder pass of the
+    model checks the tokens drafted since its previous pass and adds one token of its own, so all generated tokens
+    but one per pass of the model are accepted drafts.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.model_passes = 0
+        self.drafted_tokens = 0
+        self.generated_tokens = 0
+
+    @contextmanager
+    def count_passes(self, model, assistant_model):
+        """Counts the decoder passes of `model` and `assistant_model`, one drafted token per pass of the latter."""
+
+        def count_model_pass(module, args, output):
+            self.model_passes += 1
+
+        def count_draft_pass(module, args, output):
+            self.drafted_tokens += 1
+
+        handles = [
+            model.get_decoder().register_forward_hook(count_model_pass),
+            assistant_model.get_decoder().register_forward_hook(count_draft_pass),
+        ]
+        try:
+            yield
+        finally:
+            for handle in handles:
+                handle.remove()
+
+    def add(self, sequences, eos_token_id):
+        """Counts the tokens of generated `sequences`, without the decoder prompt, up to their first end of text."""
+        for row in sequences:
+            row = list(row)
+            self.generated_tokens += row.index(eos_token_id) + 1 if eos_token_id in row else len(row)
+
+    def metrics(self):
+        return {
+            "draft_acceptance_rate": (self.generated_tokens - self.model_passes) / max(self.drafted_tokens, 1),
+            "tokens_per_model_pass": self.generated_tokens / max(self.model_passes, 1),
+        }